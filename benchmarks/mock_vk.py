@@ -0,0 +1,406 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Local stand-in for VK API used by benchmarks.
+
+Serves wall.get, utils.resolveScreenName and execute (for the code
+generated by vktop, including field projection of lean mode) over synthetic
+walls. Every wall is generated deterministically from owner_id, so runs are
+reproducible.
+
+    python benchmarks/mock_vk.py --posts 200000 --latency 0.05 --port 8080
+    VKTOP_API_URL=http://127.0.0.1:8080/method/ vktop club1
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from array import array
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+EXECUTE_CALL_REGEXP = re.compile(r"API\.([\w.]+)\((\{.*?\})\)")
+# Projection code of lean mode, see vktop.api.projection_code
+VARIABLE_REGEXP = re.compile(r"var (\w+) = API\.([\w.]+)\((\{.*?\})\);")
+OBJECT_REGEXP = re.compile(r"\{([^{}]*)\}")
+FIELD_REGEXP = re.compile(r'"(\w+)":(\w+)\.([\w@.]+)')
+
+TOO_MANY_REQUESTS = {"error_code": 6, "error_msg": "Too many requests per second"}
+INTERNAL_ERROR = {"error_code": 10, "error_msg": "Internal server error"}
+AUTHORIZATION_FAILED = {"error_code": 5, "error_msg": "User authorization failed"}
+
+# Words of texts with --words, the first ones are the most frequent
+WORDS = (
+    u"и в на новости Москва Москве москвы ёлка Елка city news "
+    u"погода концерт фестиваль выставка метро парк"
+).split()
+
+
+def project(value, path):
+    """ Evaluates VKScript field access like 'items@.likes@.count' """
+    mapped = False
+    for name in path.split("."):
+        if mapped:
+            value = [item.get(name.rstrip("@")) for item in value]
+        else:
+            value = value.get(name.rstrip("@"))
+        mapped = mapped or name.endswith("@")
+    return value
+
+
+class Wall:
+    """
+    Synthetic wall, posts are built on request from their offset.
+    With --publish-rate or --delete-rate the wall changes while it is
+    downloaded: new posts appear on top and random posts disappear.
+    """
+
+    def __init__(self, owner_id, config):
+        self.owner_id = owner_id
+        self.config = config
+        self.size = config.posts + (1 if config.pinned else 0)
+
+        # Publication times from the newest post to the oldest one
+        rnd = random.Random(owner_id)
+        now, gap = time.time(), config.interval
+        self.dates = array("d")
+        for _ in range(config.posts):
+            self.dates.append(now)
+            if config.dates == "uniform":
+                now -= gap
+            else:
+                now -= rnd.expovariate(1.0 / gap)
+
+        # (id, date, seed) of posts of changing wall, newest first
+        self.posts = None
+        if config.publish_rate or config.delete_rate:
+            self.posts = [
+                (config.posts - offset + 1, self.dates[offset], offset)
+                for offset in range(config.posts)
+            ]
+            self.created = time.time()
+            self.published = 0
+            self.deleted = []
+            self._random = random.Random(owner_id)
+            self._lock = threading.Lock()
+
+    def _change(self):
+        """ Publishes and deletes posts due since the wall was created """
+        elapsed = time.time() - self.created
+        while self.published < int(elapsed * self.config.publish_rate):
+            self.published += 1
+            seed = -self.published
+            post_id = self.config.posts + self.published
+            self.posts.insert(0, (post_id, time.time(), seed))
+        while len(self.deleted) < int(elapsed * self.config.delete_rate) and self.posts:
+            post_id = self.posts.pop(self._random.randrange(len(self.posts)))[0]
+            self.deleted.append(post_id)
+        self.size = len(self.posts) + (1 if self.config.pinned else 0)
+
+    def item(self, offset):
+        config = self.config
+        if config.pinned:
+            if offset == 0:
+                return self._item(1, self.dates[-1] - 10 * config.interval, 0, pinned=1)
+            offset -= 1
+        if self.posts is not None:
+            return self._item(*self.posts[offset])
+        return self._item(config.posts - offset + 1, self.dates[offset], offset)
+
+    def _text(self, rnd):
+        if not self.config.words:
+            return "x" * self.config.text_size
+        words, size = [], -1
+        while size < self.config.text_size:
+            # Zipf-like frequencies of words
+            words.append(WORDS[min(int(rnd.paretovariate(1.0)) - 1, len(WORDS) - 1)])
+            size += len(words[-1]) + 1
+        return " ".join(words)
+
+    def _item(self, post_id, date, seed, pinned=0):
+        rnd = random.Random(self.owner_id * 1000003 + seed)
+        likes = int(rnd.paretovariate(1.2) * 10)
+        item = {
+            "id": post_id,
+            "from_id": self.owner_id,
+            "owner_id": self.owner_id,
+            "date": int(date),
+            "marked_as_ads": 0,
+            "post_type": "post",
+            "text": self._text(rnd),
+            "comments": {"count": rnd.randint(0, 100), "can_post": 1},
+            "likes": {"count": likes, "user_likes": 0, "can_like": 1},
+            "reposts": {"count": rnd.randint(0, likes // 5 + 1), "user_reposted": 0},
+            "views": {"count": likes * rnd.randint(10, 100) + 1},
+            "attachments": [{"type": "photo", "photo": {"sizes": "y" * 400}}]
+            * self.config.attachments,
+        }
+        if pinned:
+            item["is_pinned"] = 1
+        return item
+
+    def get(self, offset, count):
+        offset, count = int(offset), min(int(count), 100)
+        if self.posts is None:
+            return self._get(offset, count)
+        with self._lock:
+            self._change()
+            return self._get(offset, count)
+
+    def _get(self, offset, count):
+        return {
+            "count": self.size,
+            "items": [self.item(i) for i in range(offset, min(offset + count, self.size))],
+        }
+
+    def ids(self):
+        """ Returns ids of current and deleted posts of changing wall """
+        with self._lock:
+            self._change()
+            return {
+                "ids": [post_id for post_id, _, _ in self.posts],
+                "deleted": list(self.deleted),
+            }
+
+
+class MockVK:
+    def __init__(self, config):
+        self.config = config
+        self.walls = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        # access token -> times of its requests within the last second
+        self._recent = {}
+        self.token_requests = {}
+        self._random = random.Random(0)
+
+    def wall(self, owner_id):
+        owner_id = int(owner_id)
+        with self.lock:
+            if owner_id not in self.walls:
+                self.walls[owner_id] = Wall(owner_id, self.config)
+            return self.walls[owner_id]
+
+    def _throttled(self, token):
+        """ Checks access token, its requests rate limit and random errors """
+        with self.lock:
+            self.requests += 1
+            self.token_requests[token] = self.token_requests.get(token, 0) + 1
+            if token in self.config.revoked:
+                self.errors += 1
+                return AUTHORIZATION_FAILED
+            now = time.time()
+            recent = [t for t in self._recent.get(token, []) if now - t < 1.0]
+            self._recent[token] = recent + [now]
+            if self.config.rps_limit and len(recent) >= self.config.rps_limit:
+                self.errors += 1
+                return TOO_MANY_REQUESTS
+            if self._random.random() < self.config.error_rate:
+                self.errors += 1
+                return self._random.choice([TOO_MANY_REQUESTS, INTERNAL_ERROR])
+        return None
+
+    def call(self, method, params):
+        if method == "wall.get":
+            return self.wall(params.get("owner_id", 1)).get(
+                params.get("offset", 0), params.get("count", 20)
+            )
+        if method == "mock.wallIds":
+            return self.wall(params.get("owner_id", 1)).ids()
+        if method == "utils.resolveScreenName":
+            name = params["screen_name"]
+            if name.startswith("unknown"):
+                return []
+            return {"type": "group", "object_id": sum(map(ord, name)) % 100000 + 1}
+        raise KeyError(method)
+
+    def execute(self, code):
+        """ Runs VKScript code of a list of calls or of projection of their results """
+        if not code.startswith("var "):
+            return [
+                self.call(name, json.loads(params_json))
+                for name, params_json in EXECUTE_CALL_REGEXP.findall(code)
+            ]
+
+        variables = dict(
+            (var, self.call(name, json.loads(params_json)))
+            for var, name, params_json in VARIABLE_REGEXP.findall(code)
+        )
+        returned = code[code.index("return") :]
+        return [
+            dict(
+                (key, project(variables[var], path))
+                for key, var, path in FIELD_REGEXP.findall(fields)
+            )
+            for fields in OBJECT_REGEXP.findall(returned)
+        ]
+
+    def handle(self, method, params):
+        if method == "stats":
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "bytes": self.bytes_sent,
+                "tokens": self.token_requests,
+            }
+
+        error = self._throttled(params.get("access_token"))
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        if error:
+            return {"error": error}
+
+        try:
+            if method == "execute":
+                return {"response": self.execute(params["code"])}
+            return {"response": self.call(method, params)}
+        except KeyError as error:
+            return {"error": {"error_code": 3, "error_msg": "Unknown: {}".format(error)}}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(config, host="127.0.0.1", port=0):
+    """ Returns HTTP server serving MockVK, port 0 picks a free one """
+    api = MockVK(config)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self._respond(parse_qs(urlparse(self.path).query))
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            params = parse_qs(urlparse(self.path).query)
+            params.update(parse_qs(self.rfile.read(length).decode("utf-8")))
+            self._respond(params)
+
+        def _respond(self, params):
+            method = urlparse(self.path).path.rsplit("/", 1)[-1]
+            params = dict((key, values[0]) for key, values in params.items())
+            body = json.dumps(api.handle(method, params)).encode("utf-8")
+            with api.lock:
+                api.bytes_sent += len(body)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.api = api
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--posts", type=int, default=10000, help="posts per wall")
+    parser.add_argument(
+        "--interval", type=float, default=3600, help="mean seconds between posts"
+    )
+    parser.add_argument(
+        "--dates",
+        choices=["uniform", "random"],
+        default="uniform",
+        help="distribution of gaps between posts",
+    )
+    parser.add_argument("--pinned", action="store_true", help="add old pinned post")
+    parser.add_argument("--text-size", type=int, default=200, help="chars of text")
+    parser.add_argument(
+        "--words", action="store_true", help="texts of random words, see vktop --match"
+    )
+    parser.add_argument(
+        "--attachments", type=int, default=1, help="attachments per post"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every request"
+    )
+    parser.add_argument(
+        "--rps-limit",
+        type=int,
+        default=0,
+        help="requests per second of every access token, 0 - unlimited",
+    )
+    parser.add_argument(
+        "--revoked",
+        nargs="*",
+        default=[],
+        metavar="TOKEN",
+        help="access tokens failing with authorization error",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of failed requests"
+    )
+    parser.add_argument(
+        "--publish-rate",
+        type=float,
+        default=0.0,
+        help="new posts per second appearing on top of walls",
+    )
+    parser.add_argument(
+        "--delete-rate",
+        type=float,
+        default=0.0,
+        help="random posts per second deleted from walls",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock VK API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    config = parser.parse_args()
+
+    server = make_server(config, config.host, config.port)
+    sys.stderr.write(
+        "Mock VK API at http://{}:{}/method/\n".format(*server.server_address)
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Offline benchmark of vktop download modes against local mock VK API.
+
+    python benchmarks/run.py --posts 50000 --latency 0.02 -o results.json
+    python benchmarks/run.py --posts 50000 --compare results.json
+
+Every mode runs in a separate process, so peak RSS is measured per mode.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import platform
+import threading
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import mock_vk  # noqa: E402
+
+# name -> (engine, batch size, keep top-N only, lean mode)
+MODES = {
+    "sequential": ("sequential", 1, False, False),
+    "process": ("process", 1, False, False),
+    "process-batch": ("process", 25, False, False),
+    "process-top": ("process", 1, True, False),
+    "process-lean": ("process", 25, False, True),
+    "async": ("async", 1, False, False),
+    "async-batch": ("async", 25, False, False),
+    "async-lean": ("async", 25, False, True),
+}
+
+
+def peak_rss_kb():
+    """ Peak RSS of this process and its finished children in KB """
+    usage = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in bytes on macOS
+    return usage // 1024 if sys.platform == "darwin" else usage
+
+
+def run_child(args):
+    """ Runs single mode, prints its result as JSON """
+    sys.path.insert(0, ROOT)
+    from vktop.__main__ import PostDownloader
+    from vktop.tokens import TokenPool, load_tokens, set_token_pool
+
+    set_token_pool(TokenPool(load_tokens(), max_rate=args.rate))
+
+    engine, batch_size, top_only, lean = MODES[args.child]
+    downloader = PostDownloader(
+        args.page_id,
+        batch_size=batch_size,
+        top=args.top if top_only else None,
+        keep_text=False,
+        lean=lean,
+    )
+
+    started = time.time()
+    if engine == "sequential":
+        posts = downloader.fetch()
+    elif engine == "process":
+        posts = downloader.parallel_fetch(args.workers)
+    else:
+        import asyncio
+
+        loop = asyncio.new_event_loop()
+        posts = loop.run_until_complete(downloader.async_fetch(args.concurrency))
+        loop.close()
+    wall_time = time.time() - started
+
+    json.dump(
+        {"posts": len(posts), "wall_time": wall_time, "peak_rss_kb": peak_rss_kb()},
+        sys.stdout,
+    )
+
+
+def run_mode(mode, args, server):
+    stats_before = dict(server.api.__dict__)
+    env = dict(
+        os.environ,
+        VKTOP_API_URL="http://{}:{}/method/".format(*server.server_address),
+        PYTHONPATH=ROOT,
+    )
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--child",
+            mode,
+            "--page-id",
+            str(args.page_id),
+            "--workers",
+            str(args.workers),
+            "--concurrency",
+            str(args.concurrency),
+            "--rate",
+            str(args.rate),
+            "--top",
+            str(args.top),
+        ],
+        env=env,
+    )
+    result = json.loads(output.decode("utf-8"))
+    result.update(
+        mode=mode,
+        requests=server.api.requests - stats_before["requests"],
+        api_errors=server.api.errors - stats_before["errors"],
+        bytes=server.api.bytes_sent - stats_before["bytes_sent"],
+        # Returned posts may be only top-N, rate is measured by wall size
+        posts_per_sec=(args.posts + args.pinned) / result["wall_time"],
+    )
+    return result
+
+
+def print_results(results, baseline=None):
+    baseline = dict((result["mode"], result) for result in baseline or [])
+    print(
+        "{:<16}{:>10}{:>10}{:>12}{:>14}{:>12}{:>10}".format(
+            "mode", "returned", "requests", "wall time", "posts/sec", "peak RSS", "vs base"
+        )
+    )
+    for result in results:
+        base = baseline.get(result["mode"])
+        speedup = (
+            "{:.2f}x".format(base["wall_time"] / result["wall_time"]) if base else "-"
+        )
+        print(
+            "{mode:<16}{posts:>10}{requests:>10}{wall_time:>11.2f}s"
+            "{posts_per_sec:>14.0f}{peak_rss_kb:>10}KB{speedup:>10}".format(
+                speedup=speedup, **result
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="vktop download benchmark")
+    mock_vk.add_arguments(parser)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=sorted(MODES),
+        default=sorted(MODES),
+        help="modes to run",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--rate", type=float, default=10000, help="client requests per second"
+    )
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--page-id", type=int, default=-1)
+    parser.add_argument("-o", "--output", help="save results to JSON file")
+    parser.add_argument("--compare", help="JSON file of previous run")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args)
+
+    server = mock_vk.make_server(args)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    results = [run_mode(mode, args, server) for mode in args.modes]
+    server.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as compare_file:
+            baseline = json.load(compare_file)["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        sys.path.insert(0, ROOT)
+        from vktop import __version__
+
+        with open(args.output, "w") as output:
+            json.dump(
+                {
+                    "version": __version__,
+                    "python": platform.python_version(),
+                    "timestamp": time.time(),
+                    "config": dict(
+                        (key, value)
+                        for key, value in vars(args).items()
+                        if key not in ("output", "compare", "child")
+                    ),
+                    "results": results,
+                },
+                output,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
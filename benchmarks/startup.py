@@ -0,0 +1,185 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+Benchmark of vktop startup: time of short command line calls, which make
+up most of the cost when vktop is called many times by batch jobs.
+
+    python benchmarks/startup.py -o startup.json
+    python benchmarks/startup.py --compare startup.json
+
+Calls which do not download anything must not import HTTP stack, SQLite
+or multiprocessing, the benchmark fails if they do.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import mock_vk  # noqa: E402
+
+# name -> (vktop arguments, whether it talks to the API)
+CALLS = {
+    "version": (["--version"], False),
+    "help": (["--help"], False),
+    "bad-arguments": (["--top", "x", "club1"], False),
+    "small-wall": (["club1", "--no-cache"], True),
+}
+
+# Modules which calls without API requests must not load
+HEAVY_MODULES = ("requests", "urllib3", "sqlite3", "multiprocessing", "aiohttp")
+
+
+def imported_modules(args, env):
+    """ Returns names of modules imported by vktop called with 'args' """
+    process = subprocess.Popen(
+        [sys.executable, "-X", "importtime", "-m", "vktop"] + args,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    _, stderr = process.communicate()
+    return set(
+        line.split("|")[-1].strip()
+        for line in stderr.decode("utf-8", "replace").splitlines()
+        if line.startswith("import time:")
+    )
+
+
+def run_call(name, args, env):
+    """ Runs vktop call several times, returns its timings """
+    arguments, uses_api = CALLS[name]
+    times = []
+    for _ in range(args.repeat):
+        started = time.time()
+        subprocess.call(
+            [sys.executable, "-m", "vktop"] + arguments,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        times.append(time.time() - started)
+    times.sort()
+
+    heavy = []
+    if not uses_api:
+        modules = imported_modules(arguments, env)
+        heavy = [name for name in HEAVY_MODULES if name in modules]
+    return {
+        "call": name,
+        "best": times[0],
+        "median": times[len(times) // 2],
+        "heavy_imports": heavy,
+    }
+
+
+def print_results(results, baseline=None):
+    baseline = dict((result["call"], result) for result in baseline or [])
+    print(
+        "{:<16}{:>10}{:>10}{:>10}  {}".format(
+            "call", "best", "median", "vs base", "heavy imports"
+        )
+    )
+    for result in results:
+        base = baseline.get(result["call"])
+        speedup = (
+            "{:.2f}x".format(base["median"] / result["median"]) if base else "-"
+        )
+        print(
+            "{call:<16}{best:>9.3f}s{median:>9.3f}s{speedup:>10}  {heavy}".format(
+                speedup=speedup,
+                heavy=", ".join(result["heavy_imports"]) or "-",
+                **result
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="vktop startup benchmark")
+    mock_vk.add_arguments(parser)
+    parser.set_defaults(posts=200)
+    parser.add_argument(
+        "--calls",
+        nargs="+",
+        choices=sorted(CALLS),
+        default=sorted(CALLS),
+        help="calls to run",
+    )
+    parser.add_argument("--repeat", type=int, default=10, help="runs of every call")
+    parser.add_argument("-o", "--output", help="save results to JSON file")
+    parser.add_argument("--compare", help="JSON file of previous run")
+    args = parser.parse_args()
+
+    server = mock_vk.make_server(args)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    env = dict(
+        os.environ,
+        VKTOP_API_URL="http://{}:{}/method/".format(*server.server_address),
+        PYTHONPATH=ROOT,
+    )
+    results = [run_call(name, args, env) for name in args.calls]
+    server.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as compare_file:
+            baseline = json.load(compare_file)["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        sys.path.insert(0, ROOT)
+        from vktop import __version__
+
+        with open(args.output, "w") as output:
+            json.dump(
+                {
+                    "version": __version__,
+                    "python": platform.python_version(),
+                    "timestamp": time.time(),
+                    "config": dict(
+                        (key, value)
+                        for key, value in vars(args).items()
+                        if key not in ("output", "compare")
+                    ),
+                    "results": results,
+                },
+                output,
+                indent=2,
+            )
+
+    if any(result["heavy_imports"] for result in results):
+        sys.exit("Calls without API requests import heavy modules")
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,7 @@ setup(
   name = 'vktop',
   packages=['vktop'],
   install_requires=['requests'],
+  extras_require={'async': ['aiohttp'], 'fast': ['orjson'], 'parquet': ['pyarrow'], 'numpy': ['numpy']},
   version = app_version,
   description = 'VK-Top is used for getting popular posts of any public available page at VK.com',
   author = 'Dmitry Yutkin',
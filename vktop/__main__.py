@@ -22,62 +22,405 @@
 
 from __future__ import print_function
 
-import requests
 import sys
+import bisect
+import signal
 import datetime
 from datetime import timedelta
-from multiprocessing import current_process, cpu_count
+from collections import deque
+from functools import partial
 
-from .argparser import parse_args
-from .constants import VKAPI_URL, VKAPI_VERSION, APP_ACCESS_KEY
-from .utils import get_page_id, VKApiError, pretty_print
-from .post import Post
+# Only light modules are imported here, so 'vktop --help' and argument
+# errors are fast. HTTP stack, SQLite and worker processes are loaded
+# when they are needed.
+from .argparser import parse_args, parse_serve_args
+from .argparser import parse_coordinator_args, parse_worker_args
+from .constants import WALL_PAGE_SIZE, EXECUTE_MAX_CALLS, LEAN_FIELDS
+from .constants import CHUNK_REQUESTS, CHUNK_RETRIES, GAP_MAX_REQUESTS
+from .tokens import TokenPool, load_tokens, get_token_pool, set_token_pool
+from .metrics import get_metrics
+from .post import Post, PostBatch, IdSet
+from .ranking import TopN, get_ranking, rank
 
 
 import logging
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="[\033[92m%(levelname)s %(asctime)s\033[0m]: %(message)s",
-    datefmt="%m/%d/%Y %I:%M:%S %p",
-)
-# Removing noisy debug messages from lib request
-logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 logger = logging.getLogger()
 
 
+def configure_logging():
+    """ Sets up logging of command line tool """
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[\033[92m%(levelname)s %(asctime)s\033[0m]: %(message)s",
+        datefmt="%m/%d/%Y %I:%M:%S %p",
+    )
+    # Removing noisy debug messages from lib request
+    logging.getLogger("urllib3").setLevel(logging.CRITICAL)
+
+
+# Offsets of pages where posts become older than the date range,
+# shared between worker processes of parallel download
+_shared_cutoffs = None
+# Profiler of the main process and whether worker processes profile
+# their tasks, see --profile
+_profiler = None
+_profile_workers = False
+# pstats.Stats of tasks of worker processes merged so far
+_worker_stats = None
+
+
+def _init_worker(tokens, cutoffs, profile=False):
+    """ Initializer of parallel download worker processes """
+    global _shared_cutoffs, _profile_workers
+    set_token_pool(tokens)
+    _shared_cutoffs = cutoffs
+    _profile_workers = profile
+    # Ctrl-C is handled by the parent, which stops workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Forked worker must not report metrics of its parent
+    get_metrics().drain()
+
+
+def _run_task(method, *args):
+    """
+    Runs task of parallel download in worker process.
+    Returns result of the task, metrics collected by the worker and
+    profile stats of the task or None if profiling is off.
+    """
+    if not _profile_workers:
+        return method(*args), get_metrics().drain(), None
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    result = profiler.runcall(method, *args)
+    profiler.create_stats()
+    return result, get_metrics().drain(), profiler.stats
+
+
+class _RawStats(object):
+    """ Profile stats of worker process in form accepted by pstats.Stats """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _merge_worker_stats(stats):
+    """ Adds profile stats of worker task to ones merged so far """
+    global _worker_stats
+    import pstats
+
+    if not stats:
+        return
+    # Merging must not show up in profile of the main process
+    _profiler.disable()
+    if _worker_stats is None:
+        _worker_stats = pstats.Stats(_RawStats(stats))
+    else:
+        _worker_stats.add(_RawStats(stats))
+    _profiler.enable()
+
+
 class PostDownloader:
-    def __init__(self, page_id, from_date=None, to_date=None):
+    def __init__(
+        self,
+        page_id,
+        from_date=None,
+        to_date=None,
+        batch_size=1,
+        api_options=None,
+        top=None,
+        sort_by="likes",
+        keep_text=True,
+        lean=False,
+        sink=None,
+        progress=None,
+        consistent=False,
+        match=None,
+    ):
         self.page_id = page_id
-        self.api_url = VKAPI_URL + "wall.get"
-        self.request_params = {
-            "owner_id": self.page_id,
-            "v": VKAPI_VERSION,
-            "access_token": APP_ACCESS_KEY,
-        }
+        # Callable receiving posts collected so far, number of downloaded
+        # and total number of posts to download, called in parent process
+        self.progress = progress
+        # Callable receiving posts within date range as soon as they are
+        # downloaded, it is called in the parent process only
+        self.sink = sink
+        # Workers return streamed posts in full, sink gets all of them
+        self._streamed = sink is not None
+        # Lean mode requests only fields needed for ranking, texts are dropped
+        self.lean = lean
+        # search.Query which texts of posts must match, texts are needed then
+        self.match = match
+        self.keep_text = (keep_text or match is not None) and not lean
+        # Index of the page in parallel download
+        self._slot = None
+        # If set, only 'top' most popular posts are kept while downloading
+        self.top = top
+        # Name of ranking.RANKINGS, score expression or ranking.Ranking
+        self.sort_by = sort_by
+        # Number of wall.get pages requested per single HTTP round trip
+        self.batch_size = min(batch_size, EXECUTE_MAX_CALLS)
+        # Keyword arguments of VKApi client, see api.VKApi
+        self.api_options = api_options or {}
         self.from_date = from_date or datetime.date.min
         self.to_date = to_date or datetime.date.max
+        # Consistent mode downloads the wall as it was when download started,
+        # though posts are published and deleted meanwhile, see _drifted
+        self.consistent = consistent
+        # Id of the newest post when download started, newer ones are skipped
+        self._anchor = None
+        # Offset where the wall ended when download started
+        self._end = None
+        # Ids of posts collected in parent process
+        self._seen = None
 
-    def _number_of_posts(self):
-        """ Returns total number of post on the page """
+    def __getstate__(self):
+        # Callbacks of parent process are not passed to worker processes
+        state = dict(self.__dict__)
+        state["sink"] = None
+        state["progress"] = None
+        state["_seen"] = None
+        return state
 
-        self.request_params.update({"offset": 0, "count": 1})
+    @property
+    def api(self):
+        """ API client of current process """
+        from .api import get_client
 
-        response = requests.get(self.api_url, params=self.request_params).json()
+        return get_client(**self.api_options)
 
-        if "error" in response:
-            raise VKApiError(response["error"]["error_msg"])
+    def _number_of_posts(self):
+        """ Returns total number of post on the page """
+
+        response = self.api.call("wall.get", owner_id=self.page_id, offset=0, count=1)
 
-        total_posts = response["response"]["count"]
+        total_posts = response["count"]
         logger.debug("Posts to fetch: {}".format(total_posts))
         return total_posts
 
-    def fetch(self, init_offset=0, num_to_fetch=None):
-        """ Downloads 'num_to_fetch' posts starting from 'init_offset' position """
-        num_to_fetch = num_to_fetch or self._number_of_posts()
+    def _make_post(self, item):
+        """ Builds Post object from raw wall.get item """
+        return Post(
+            id=item["id"],
+            text=item["text"] if self.keep_text else None,
+            likes=item["likes"]["count"],
+            reposts=item["reposts"]["count"],
+            date=datetime.date.fromtimestamp(item["date"]),
+            is_pinned=item.get("is_pinned", 0),
+            page_id=self.page_id,
+            comments=item.get("comments", {}).get("count", 0),
+            views=item.get("views", {}).get("count", 0),
+        )
+
+    @property
+    def _page_step(self):
+        # Pages of consistent download overlap by one post, see _drifted
+        return WALL_PAGE_SIZE - 1 if self.consistent else WALL_PAGE_SIZE
+
+    def _split_pages(self, init_offset, num_to_fetch):
+        """ Splits posts range into (offset, count) pairs of wall.get pages """
+        end = init_offset + num_to_fetch + (1 if self.consistent else 0)
+        for offset in range(init_offset, init_offset + num_to_fetch, self._page_step):
+            yield offset, min(end - offset, WALL_PAGE_SIZE)
+
+    def _request_pages(self, pages):
+        """
+        Downloads wall.get pages given as (offset, count) pairs.
+        Several pages are packed into a single 'execute' request.
+        Returns list of posts for each page.
+        """
+        from .api import projection_code, projection_results
+
+        calls = self._page_calls(pages)
+        if self.lean:
+            results = self.api.script(
+                projection_code(calls, LEAN_FIELDS), projection_results
+            )
+        elif len(calls) == 1:
+            results = [self.api.call("wall.get", **calls[0])]
+        else:
+            results = self.api.execute("wall.get", calls)
+        return [self._page_posts(result) for result in results]
+
+    def _page_calls(self, pages):
+        """ Returns wall.get parameters of (offset, count) pages """
+        return [
+            {"owner_id": self.page_id, "offset": offset, "count": count}
+            for offset, count in pages
+        ]
+
+    def _page_posts(self, result):
+        """ Returns posts of wall.get page result """
+        if self.lean:
+            return PostBatch.from_columns(
+                self.page_id,
+                result["id"],
+                result["likes"],
+                result["reposts"],
+                result["date"],
+                result["is_pinned"],
+                result["comments"],
+                result["views"],
+            )
+        return [self._make_post(item) for item in result["items"]]
+
+    def _search_offset(self, lo, hi, is_reached):
+        """
+        Binary search of the first offset in [lo, hi) where 'is_reached'
+        returns True for the post (hi if there is no such post).
+        When batching is on, several offsets are probed per request.
+        """
+        while lo < hi:
+            probes = self._probe_offsets(lo, hi)
+            pages = self._request_pages([(offset, 1) for offset in probes])
+            lo, hi = self._narrow(lo, hi, probes, pages, is_reached)
+        return lo
+
+    def _probe_offsets(self, lo, hi):
+        """ Returns offsets probed by a single step of _search_offset """
+        num_probes = min(self.batch_size, hi - lo)
+        step = float(hi - lo) / (num_probes + 1)
+        return sorted(set(lo + int(step * (i + 1)) for i in range(num_probes)))
+
+    def _narrow(self, lo, hi, probes, pages, is_reached):
+        """ Returns [lo, hi) range of _search_offset left after probing """
+        for offset, posts in zip(probes, pages):
+            # Empty page means that wall became shorter
+            if not len(posts) or is_reached(posts[0]):
+                return lo, offset
+            lo = offset + 1
+        return lo, hi
+
+    def _date_window(self, num_posts, find_stop=True):
+        """
+        Finds range of offsets of posts published between 'from_date' and
+        'to_date'. Returns start and stop offsets and pinned post, which is
+        out of chronological order, or None.
+        If 'find_stop' is False, end of the wall is returned as stop offset.
+        """
+        if self.to_date == datetime.date.max and (
+            self.from_date == datetime.date.min or not find_stop
+        ):
+            return 0, num_posts, None
+
+        start, pinned = 0, None
+        first_page = self._request_pages([(0, 1)])[0]
+        if len(first_page) and first_page[0].is_pinned:
+            start, pinned = 1, first_page[0]
+
+        if self.to_date != datetime.date.max:
+            start = self._search_offset(
+                start, num_posts, lambda post: post.date <= self.to_date
+            )
+
+        stop = num_posts
+        if find_stop and self.from_date != datetime.date.min:
+            stop = self._search_offset(start, num_posts, self._is_before_range)
+
+        logger.debug("Posts within date range: {}-{}".format(start, stop))
+        return start, stop, pinned
+
+    def _in_range(self, post):
+        return self.from_date <= post.date <= self.to_date
+
+    def _selected(self, post):
+        """ Checks that post is within date range and matches 'match' query """
+        return self._in_range(post) and (
+            self.match is None or self.match.matches(post.text)
+        )
+
+    def _snapshot(self, start):
+        """
+        Returns id of the newest post, which is the anchor of consistent
+        download, and ids of the page preceding 'start' offset, or None
+        if download starts from the top of the wall.
+        """
+        first_page = self._request_pages([(0, 2)])[0]
+        anchor = max([post.id for post in first_page if not post.is_pinned] or [0])
+        if not start:
+            return anchor, None
+
+        top = max(start - self._page_step, 0)
+        page = self._request_pages([(top, start - top + 1)])[0]
+        return anchor, [post.id for post in page if not post.is_pinned]
+
+    def _in_snapshot(self, post):
+        """ Checks that post was published before download started """
+        return self._anchor is None or post.is_pinned or post.id <= self._anchor
+
+    def _collector(self):
+        """ Returns container for downloaded posts """
+        if self.top:
+            return TopN(self.top, get_ranking(self.sort_by).key)
+        return PostBatch(self.page_id, self.keep_text)
+
+    def _chunk_collector(self):
+        """ Returns container for posts of a chunk downloaded by worker """
+        if self._streamed and self.sink is None:
+            return PostBatch(self.page_id, self.keep_text)
+        return self._collector()
+
+    def _posts(self, collector):
+        """ Returns posts kept by collector """
+        return list(collector) if isinstance(collector, TopN) else collector
+
+    def _emit(self, posts, collector):
+        """ Passes downloaded posts to sink and adds them to collector """
+        # Posts downloaded twice because the wall has changed are dropped
+        if self._seen is not None:
+            posts = [post for post in posts if self._seen.add(post.id)]
+        if self.sink is not None and len(posts):
+            self.sink(posts)
+        collector.extend(posts)
+
+    def _report(self, collector, done, total):
+        """ Reports progress of download, see 'progress' """
+        if self.progress is not None:
+            self.progress(collector, done, total)
+
+    def fetch(self, init_offset=0, num_to_fetch=None, total=None):
+        """
+        Downloads 'num_to_fetch' posts starting from 'init_offset' position.
+        'total' is number of posts on the wall, if it is known already.
+        """
+        if num_to_fetch:
+            return self._fetch_chunk(init_offset, num_to_fetch)[0]
+
+        if total is None:
+            total = self._number_of_posts()
+        start, stop, pinned = self._date_window(total, find_stop=False)
+        tail = None
+        if self.consistent:
+            self._anchor, tail = self._snapshot(start)
+            self._end = stop
+        fetched_posts = self._collector()
+        if pinned and self._selected(pinned):
+            self._emit([pinned], fetched_posts)
+        self._report(fetched_posts, 0, stop - start)
+        if start < stop:
+            self._fetch_chunk(start, stop - start, fetched_posts, tail)
+        return self._posts(fetched_posts)
 
-        self.request_params['offset'] = init_offset
-        self.request_params['count'] = min(num_to_fetch, 100)
+    def _is_before_range(self, post):
+        """ Checks that post and all subsequent posts are older than 'from_date' """
+        return post.date < self.from_date and post.is_pinned == 0
+
+    def _fetch_chunk(self, init_offset=0, num_to_fetch=None, collector=None, tail=None):
+        """
+        Downloads posts same as fetch(), into 'collector' if it is given.
+        Also returns offset of the page where posts become older than
+        'from_date' or None if the chunk has not reached it, and in
+        consistent mode (head, tail, ended) edges of the chunk: ids of its
+        first and last pages and whether the wall or date range ends there.
+        'tail' is ids of the page preceding the chunk, if they are known.
+        """
+        from multiprocessing import current_process
+
+        num_to_fetch = num_to_fetch or self._number_of_posts()
 
         logger.debug(
             "{} trying to download {} posts".format(
@@ -85,95 +428,519 @@ class PostDownloader:
             )
         )
 
-        fetched_posts, fetched_counter = [], 0
-        while fetched_counter != num_to_fetch:
-            response = requests.get(self.api_url, self.request_params).json()
+        pages = list(self._split_pages(init_offset, num_to_fetch))
 
-            if "error" in response:
-                raise VKApiError(response["error"]["error_msg"])
+        fetched_posts, fetched_counter = collector, 0
+        if fetched_posts is None:
+            fetched_posts = self._chunk_collector()
+        head, ended, seen = None, False, IdSet()
+        i = 0
+        while i < len(pages):
+            batch = pages[i : i + self.batch_size]
+            i += len(batch)
 
-            posts = response["response"]["items"]
-            fetched_counter += len(posts)
+            # Other worker has already found the end of date range
+            if self._slot is not None and _shared_cutoffs is not None:
+                cutoff = _shared_cutoffs[self._slot]
+                if batch[0][0] > cutoff:
+                    logger.debug(
+                        "{} skips posts beyond offset {}".format(
+                            current_process().name, cutoff
+                        )
+                    )
+                    break
 
-            logger.debug(
-                "{} downloaded {}/{} posts".format(
-                    current_process().name, fetched_counter, num_to_fetch
-                )
-            )
+            batch_posts, boundary = [], None
+            for (offset, count), posts in zip(batch, self._request_pages(batch)):
+                fetched_counter += len(posts)
+                get_metrics().count("posts", value=len(posts))
 
-            for post in posts:
-                post = Post(
-                    id=post["id"],
-                    text=post["text"],
-                    likes=post["likes"]["count"],
-                    reposts=post["reposts"]["count"],
-                    date=datetime.date.fromtimestamp(post["date"]),
-                    url="https://vk.com/wall{}_{}".format(self.page_id, post["id"]),
-                    is_pinned=post.get("is_pinned", 0)
+                logger.debug(
+                    "{} downloaded {}/{} posts".format(
+                        current_process().name, fetched_counter, num_to_fetch
+                    )
                 )
-                if self.from_date <= post.date <= self.to_date:
-                    fetched_posts.append(post)
 
-                # Early stopping, all subsequent post should be discarded
-                elif post.date < self.from_date and post.is_pinned == 0:
-                    logger.debug(
-                        "{} finally returns {} posts".format(
-                            current_process().name, len(fetched_posts)
-                        )
+                if self.consistent:
+                    ids = [post.id for post in posts if not post.is_pinned]
+                    if tail is not None and _drifted(tail, ids):
+                        batch_posts.extend(self._fill_gap(offset, tail, ids))
+                    head = ids if head is None else head
+                    tail = ids
+                # Short page is the end of the wall
+                ended = len(posts) < count
+
+                for post in posts:
+                    if self._selected(post):
+                        batch_posts.append(post)
+
+                    # Early stopping, all subsequent post should be discarded
+                    elif self._is_before_range(post):
+                        boundary = offset
+                        break
+                if boundary is not None or ended:
+                    break
+
+            if self.consistent:
+                batch_posts = [
+                    post
+                    for post in batch_posts
+                    if self._in_snapshot(post) and seen.add(post.id)
+                ]
+            self._emit(batch_posts, fetched_posts)
+            self._report(
+                fetched_posts,
+                num_to_fetch
+                if boundary is not None or ended
+                else min(fetched_counter, num_to_fetch),
+                num_to_fetch,
+            )
+            if boundary is not None:
+                logger.debug(
+                    "{} finally returns {} posts".format(
+                        current_process().name, len(fetched_posts)
                     )
-                    return fetched_posts
+                )
+                return (
+                    self._posts(fetched_posts),
+                    boundary,
+                    self._edges(head, tail, True),
+                )
+            if ended:
+                break
 
-            self.request_params["offset"] += 100
-            self.request_params["count"] = min(num_to_fetch - fetched_counter, 100)
+            # Posts pushed beyond the end of the wall by new ones are
+            # downloaded by the last chunk, which goes on until a short page
+            if (
+                self.consistent
+                and i == len(pages)
+                and init_offset + num_to_fetch >= self._end
+            ):
+                offset, count = pages[-1]
+                pages.append((offset + count - 1, WALL_PAGE_SIZE))
 
         logger.debug(
             "{} returns eventually {} posts".format(
                 current_process().name, len(fetched_posts)
             )
         )
-        return fetched_posts
+        return self._posts(fetched_posts), None, self._edges(head, tail, ended)
 
-    def parallel_fetch(self, max_workers=None):
+    def _edges(self, head, tail, ended):
+        """ Returns edges of downloaded chunk, see _fetch_chunk """
+        if not self.consistent:
+            return None
+        return head or [], tail or [], ended
+
+    def _fill_gap(self, offset, tail, head):
         """
-        Downloads posts in parallel processes.
-        Each worker downloads independent segment.
+        Downloads posts skipped between two pages of consistent download,
+        see _drifted. 'tail' is ids of the former page and 'head' is ids
+        of the latter one, which starts at 'offset'.
         """
+        get_metrics().count("gaps")
+        logger.debug(
+            "Page {} has changed at offset {}, downloading skipped posts".format(
+                self.page_id, offset
+            )
+        )
+        tail, head = set(tail), set(head)
 
-        from concurrent.futures import ProcessPoolExecutor
-        from concurrent.futures import as_completed
+        # Pages around 'offset' are requested until both pages are found
+        top = max(offset - self._page_step, 0)
+        posts = self._request_pages([(top, offset - top + 1)])[0]
+        bottom, ended = offset + 1, len(posts) < offset - top + 1
+        requests = 1
+        while True:
+            ids = [post.id for post in posts]
+            has_tail = top == 0 or not tail.isdisjoint(ids)
+            has_head = ended or not head.isdisjoint(ids)
+            if has_tail and has_head:
+                break
+            if requests == GAP_MAX_REQUESTS:
+                logger.warning(
+                    "Page {} changes too fast, some posts may be missed".format(
+                        self.page_id
+                    )
+                )
+                break
+            requests += 1
+
+            if not has_tail:
+                top = max(top - self._page_step, 0)
+                posts = _join_pages(
+                    self._request_pages([(top, WALL_PAGE_SIZE)])[0], posts
+                )
+            else:
+                page = self._request_pages([(bottom - 1, WALL_PAGE_SIZE)])[0]
+                bottom, ended = bottom + self._page_step, len(page) < WALL_PAGE_SIZE
+                posts = _join_pages(posts, page)
 
-        # Total number of posts to download
-        num_posts = self._number_of_posts()
-        num_workers = max_workers or cpu_count()
+        ids = [post.id for post in posts]
+        first = max([i + 1 for i, post_id in enumerate(ids) if post_id in tail] or [0])
+        last = min(
+            [i for i, post_id in enumerate(ids) if post_id in head and i >= first]
+            or [len(ids)]
+        )
+        return [
+            post
+            for post in posts[first:last]
+            if self._selected(post) and self._in_snapshot(post) and not post.is_pinned
+        ]
 
-        fetched_posts = []
-        with ProcessPoolExecutor(max_workers=num_workers) as executor:
-            futures = []
-            for offset, count in self._distribute_posts(num_posts, num_workers):
-                futures.append(executor.submit(self.fetch, offset, count))
+    def _plan(self):
+        """
+        Returns offsets of posts to download and pinned post, see _date_window,
+        then anchor and ids of the page preceding the first chunk of consistent
+        download or Nones, see _snapshot.
+        """
+        start, stop, pinned = self._date_window(self._number_of_posts())
+        anchor, tail = self._snapshot(start) if self.consistent else (None, None)
+        return start, stop, pinned, anchor, tail
 
-            for future in as_completed(futures):
-                try:
-                    fetched_posts.extend(future.result())
-                except Exception as error:
-                    logger.error(error)
+    def parallel_fetch(self, max_workers=None):
+        """ Downloads posts in parallel processes, see parallel_fetch_pages """
+        return parallel_fetch_pages([self], max_workers)[0]
 
-        return fetched_posts
+    def _split_chunks(self, start, stop):
+        """
+        Splits posts between 'start' and 'stop' offsets into chunks for workers.
+        Returns start position for downloading and number of posts to fetch.
+        """
+        chunk_size = self._page_step * self.batch_size * CHUNK_REQUESTS
+        for offset in range(start, stop, chunk_size):
+            yield offset, min(chunk_size, stop - offset)
 
-    def _distribute_posts(self, total_posts, workers):
+    def async_fetch(self, concurrency=None):
         """
-        Uniformly distributes posts for downloading between workers.
-        Returns next start position for downloading and number of posts to fetch.
+        Returns coroutine which downloads posts on a single event loop.
+        Up to 'concurrency' pages are requested simultaneously.
         """
-        per_worker = total_posts // workers + total_posts % workers
-        for offset in range(0, total_posts, per_worker):
-            if (offset + per_worker) < total_posts:
-                yield offset, per_worker
-            else:
-                yield offset, total_posts - offset
+        from .aio import fetch_async
+
+        return fetch_async(self, concurrency)
+
+
+def _drifted(tail, head):
+    """
+    Checks that posts may be skipped between two adjacent pages of
+    consistent download, given their ids. Such pages overlap by one post,
+    which is found in both of them unless posts were deleted meanwhile.
+    Ids are compared by membership, not order, because posts published
+    by schedule break order of ids.
+    """
+    if not tail:
+        return False
+    if not head:
+        return True
+    return head[0] not in tail and tail[-1] not in head
+
+
+def _join_pages(first, second):
+    """ Joins adjacent pages, posts of 'second' found in 'first' are dropped """
+    ids = set(post.id for post in first)
+    return list(first) + [post for post in second if post.id not in ids]
+
+
+def parallel_fetch_pages(downloaders, max_workers=None, return_exceptions=False):
+    """
+    Downloads posts of several pages in parallel processes.
+    All pages share one pool of workers. Walls are split into small chunks,
+    every idle worker takes the next one. Failed chunks are put back to
+    the queue and retried.
+    Only posts within date range are downloaded. Once some worker reaches
+    posts older than 'from_date', chunks of that page beyond that point
+    are cancelled.
+    In consistent mode, edges of adjacent chunks are compared and posts
+    skipped between them because the wall has changed are downloaded by
+    extra tasks, see _drifted.
+    Returns list of downloaded posts for every downloader. If some page
+    fails and 'return_exceptions' is True, its error is returned in place
+    of posts instead of being raised.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import wait, FIRST_COMPLETED
+    from multiprocessing import cpu_count, active_children, Array
+
+    num_workers = max_workers or cpu_count()
+
+    for slot, downloader in enumerate(downloaders):
+        downloader._slot = slot
+    results = [downloader._collector() for downloader in downloaders]
+    # Offsets of pages where posts become older than 'from_date'
+    cutoffs = Array("q", len(downloaders))
+    # Numbers of downloaded and all posts to download of every page
+    progress = [[0, 0] for _ in downloaders]
+
+    # Consistent mode: sorted offsets of chunks of every page, with -1 for
+    # the page preceding the first chunk, and edges of downloaded chunks
+    chunk_offsets = [[] for _ in downloaders]
+    edges = [{} for _ in downloaders]
+
+    # (slot, offset, count, attempt, gap) of tasks waiting for a worker,
+    # task without offset finds out which posts of the page to download,
+    # task with (tail, head) gap downloads posts skipped at chunk 'offset'
+    tasks = deque((slot, None, None, 0, None) for slot in range(len(downloaders)))
+
+    def check_drift(slot, offset):
+        """ Puts tasks downloading posts skipped next to chunk at 'offset' """
+        offsets = chunk_offsets[slot]
+        index = bisect.bisect_left(offsets, offset)
+        for former, latter in ((index - 1, index), (index, index + 1)):
+            if former < 0 or latter >= len(offsets):
+                continue
+            if offsets[former] not in edges[slot] or offsets[latter] not in edges[slot]:
+                continue
+            _, tail, ended = edges[slot][offsets[former]]
+            head = edges[slot][offsets[latter]][0]
+            if not ended and _drifted(tail, head):
+                tasks.append((slot, offsets[latter], 0, 0, (tail, head)))
+
+    def cancel_page(slot, boundary=-1):
+        """ Cancels tasks of the page beyond 'boundary' offset """
+        cutoffs[slot] = boundary
+        tasks_left = deque(
+            task
+            for task in tasks
+            if task[0] != slot or (task[1] is not None and task[1] <= boundary)
+        )
+        tasks.clear()
+        tasks.extend(tasks_left)
+        for future, (other_slot, offset, _, _, _) in running.items():
+            if other_slot == slot and offset is not None and offset > boundary:
+                future.cancel()
+
+        # Only posts up to the boundary are left to download
+        progress[slot][1] = progress[slot][0] + sum(
+            count
+            for other_slot, offset, count, _, _ in list(tasks) + list(running.values())
+            if other_slot == slot and offset is not None and offset <= boundary
+        )
+
+    # Processes started before, workers are the rest of child processes
+    other_processes = set(active_children())
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_worker,
+        initargs=(get_token_pool(), cutoffs, _profiler is not None),
+    ) as executor:
+        running = {}
+        try:
+            while tasks or running:
+                # One extra task per worker hides scheduling latency
+                while tasks and len(running) < 2 * num_workers:
+                    task = tasks.popleft()
+                    slot, offset, count, _, gap = task
+                    if offset is None:
+                        future = executor.submit(_run_task, downloaders[slot]._plan)
+                    elif gap is not None:
+                        future = executor.submit(
+                            _run_task, downloaders[slot]._fill_gap, offset, *gap
+                        )
+                    else:
+                        future = executor.submit(
+                            _run_task, downloaders[slot]._fetch_chunk, offset, count
+                        )
+                    running[future] = task
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    slot, offset, count, attempt, gap = running.pop(future)
+                    downloader = downloaders[slot]
+                    if future.cancelled() or (
+                        offset is not None and offset > cutoffs[slot]
+                    ):
+                        continue
+
+                    try:
+                        result, worker_metrics, worker_stats = future.result()
+                        get_metrics().merge(worker_metrics)
+                        _merge_worker_stats(worker_stats)
+                    except Exception as error:
+                        if attempt < CHUNK_RETRIES:
+                            logger.warning(
+                                "Page {} {} failed ({}), retrying".format(
+                                    downloader.page_id,
+                                    "counting"
+                                    if offset is None
+                                    else "skipped posts at {}".format(offset)
+                                    if gap is not None
+                                    else "posts {}-{}".format(offset, offset + count),
+                                    error,
+                                )
+                            )
+                            tasks.append((slot, offset, count, attempt + 1, gap))
+                        elif return_exceptions:
+                            logger.error(
+                                "Page {}: {}".format(downloader.page_id, error)
+                            )
+                            results[slot] = error
+                            cancel_page(slot)
+                        else:
+                            raise
+                        continue
+
+                    if offset is None:
+                        start, stop, pinned, anchor, tail = result
+                        chunks = list(downloader._split_chunks(start, stop))
+                        cutoffs[slot] = stop
+                        if downloader.consistent:
+                            # The last chunk may go beyond 'stop', see _fetch_chunk
+                            cutoffs[slot] = sys.maxsize
+                            downloader._anchor, downloader._end = anchor, stop
+                            downloader._seen = IdSet(anchor)
+                            chunk_offsets[slot] = [-1] + [
+                                chunk_offset for chunk_offset, _ in chunks
+                            ]
+                            edges[slot][-1] = ([], tail or [], tail is None)
+                        progress[slot][1] = stop - start
+                        if pinned and downloader._selected(pinned):
+                            downloader._emit([pinned], results[slot])
+                        downloader._report(results[slot], *progress[slot])
+                        tasks.extend(
+                            (slot, chunk_offset, chunk_count, 0, None)
+                            for chunk_offset, chunk_count in chunks
+                        )
+                        continue
+
+                    if gap is not None:
+                        downloader._emit(result, results[slot])
+                        downloader._report(results[slot], *progress[slot])
+                        continue
+
+                    posts, boundary, chunk_edges = result
+                    downloader._emit(posts, results[slot])
+                    progress[slot][0] += count
+                    if chunk_edges is not None:
+                        edges[slot][offset] = chunk_edges
+                        check_drift(slot, offset)
+                    if boundary is not None and boundary < cutoffs[slot]:
+                        logger.debug(
+                            "Page {} posts beyond offset {} are too old".format(
+                                downloader.page_id, boundary
+                            )
+                        )
+                        cancel_page(slot, boundary)
+                    downloader._report(results[slot], *progress[slot])
+        except KeyboardInterrupt:
+            # Results of running tasks would be thrown away, so workers are
+            # stopped instead of waited for. Repeated Ctrl-C must not break
+            # off the shutdown and leave workers behind.
+            handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                for process in active_children():
+                    if process not in other_processes:
+                        process.terminate()
+                executor.shutdown(wait=True)
+            finally:
+                signal.signal(signal.SIGINT, handler)
+            raise
+
+    return [
+        result if isinstance(result, Exception) else downloader._posts(result)
+        for downloader, result in zip(downloaders, results)
+    ]
+
+
+def download(downloaders, args):
+    """
+    Downloads posts of pages with engine chosen by command line arguments.
+    Returns list of posts or error for every downloader.
+    """
+    if args["engine"] == "async":
+        import asyncio
+        from .aio import fetch_pages_async
+
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(
+            fetch_pages_async(downloaders, args["workers"], return_exceptions=True)
+        )
+        # Ctrl-C cancels requests in flight and closes connections
+        try:
+            loop.add_signal_handler(signal.SIGINT, task.cancel)
+        except NotImplementedError:
+            pass
+        try:
+            return loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            raise KeyboardInterrupt()
+        finally:
+            loop.close()
+    elif sys.version_info > (3, 0):
+        totals = _count_small_walls(downloaders)
+        if totals is not None:
+            logger.debug("Walls are small, downloading them without workers")
+            return fetch_pages(downloaders, totals)
+        return parallel_fetch_pages(
+            downloaders, args["workers"], return_exceptions=True
+        )
+    else:
+        # TODO:
+        # Python 2.x does not support concurrent.futures out of the box,
+        # therefore in Python 2.x using synchronous downloading
+        if args["workers"]:
+            logger.warning("Python 2 does not support parallel downloading!")
+        return fetch_pages(downloaders)
+
+
+def _count_small_walls(downloaders):
+    """
+    Returns numbers of posts on walls if all of them fit into a single
+    chunk of parallel download, otherwise None. Such walls would be
+    downloaded by one worker anyway, so starting workers is not worth it.
+    """
+    import requests
+    from .api import VKApiError
+
+    chunk_size = WALL_PAGE_SIZE * CHUNK_REQUESTS * downloaders[0].batch_size
+    totals = []
+    try:
+        for downloader in downloaders:
+            totals.append(downloader._number_of_posts())
+            if sum(totals) > chunk_size:
+                return None
+    except (VKApiError, requests.exceptions.RequestException):
+        # Workers will retry
+        return None
+    return totals
+
+
+def fetch_pages(downloaders, totals=None):
+    """
+    Downloads posts of several pages one by one in the current process.
+    'totals' are numbers of posts on the walls, if they are known already.
+    Returns list of downloaded posts or error for every downloader.
+    """
+    import requests
+    from .api import VKApiError
+
+    results = []
+    for downloader, total in zip(downloaders, totals or [None] * len(downloaders)):
+        try:
+            results.append(downloader.fetch(total=total))
+        except (VKApiError, requests.exceptions.RequestException) as error:
+            logger.error("Page {}: {}".format(downloader.page_id, error))
+            results.append(error)
+    return results
 
 
 def main():
+    global _profiler
+    configure_logging()
+    if sys.argv[1:2] == ["serve"]:
+        from .server import serve
+
+        sys.exit(serve(parse_serve_args(sys.argv[2:])))
+    if sys.argv[1:2] == ["coordinator"]:
+        from .cluster import coordinate
+
+        sys.exit(coordinate(parse_coordinator_args(sys.argv[2:])))
+    if sys.argv[1:2] == ["worker"]:
+        from .cluster import work
+
+        sys.exit(work(parse_worker_args(sys.argv[2:])))
+
     args = vars(parse_args())
     if args["verbose"]:
         logger.setLevel(logging.DEBUG)
@@ -188,38 +955,271 @@ def main():
         else:
             args["from"] = datetime.date.today() - timedelta(days=args["days"])
 
+    if args["output"] and args["db"]:
+        logger.error("vktop: error: -o/--output cannot be used with --db option")
+        sys.exit(1)
+
+    if args["match"] and args["lean"]:
+        logger.error(
+            "vktop: error: --match cannot be used with --lean option, "
+            "texts of posts are needed"
+        )
+        sys.exit(1)
+
+    if args["trending"] and not args["db"]:
+        logger.error("vktop: error: --trending requires --db option")
+        sys.exit(1)
+
+    if args["trending"] and (
+        args["score"] or args["sort"] not in (None, "likes", "reposts")
+    ):
+        logger.error(
+            "vktop: error: --trending sorts posts by growth of likes or reposts only"
+        )
+        sys.exit(1)
+
+    if args["live"] and (args["db"] or args["output"] == "-"):
+        logger.error(
+            "vktop: error: --live cannot be used with --db option "
+            "or with -o/--output to stdout"
+        )
+        sys.exit(1)
+
+    if args["live"] and not sys.stdout.isatty():
+        logger.warning("--live is ignored, output is not a terminal")
+        args["live"] = False
+
+    if args["engine"] == "async" and sys.version_info < (3, 5):
+        logger.error("vktop: error: async engine requires Python 3.5 or newer")
+        sys.exit(1)
+
+    if args["consistent"] and args["engine"] == "async":
+        logger.error("vktop: error: --consistent cannot be used with async engine")
+        sys.exit(1)
+
+    if bool(args["url"]) == bool(args["input"]):
+        logger.error("vktop: error: either <url> or -i/--input must be given")
+        sys.exit(1)
+
+    import sqlite3
+    import requests
+    from .api import get_client
+    from .utils import get_page_ids, read_urls
+    from .resolver import ScreenNameCache
+
+    if args["url"]:
+        urls = [(args["url"]["text"], args["url"])]
+    else:
+        try:
+            urls = read_urls(args["input"])
+        except IOError as error:
+            logger.error(error)
+            sys.exit(1)
+
     try:
-        page_id = get_page_id(args["url"])
-    except (RuntimeError, requests.exceptions.ConnectionError) as error:
+        tokens = load_tokens(args["tokens"])
+    except (IOError, ValueError) as error:
+        logger.error(error)
+        sys.exit(1)
+    logger.debug("Using {} access tokens".format(len(tokens)))
+
+    api_options = {"timeout": args["timeout"]}
+    set_token_pool(
+        TokenPool(tokens, max_rate=args["rate"], strategy=args["token_strategy"])
+    )
+
+    try:
+        cache = None if args["no_cache"] else ScreenNameCache()
+    except (OSError, sqlite3.Error) as error:
+        logger.warning("Screen names cache is unavailable: {}".format(error))
+        cache = None
+
+    try:
+        page_ids = get_page_ids(
+            [url for _, url in urls], get_client(**api_options), cache
+        )
+    except (RuntimeError, requests.exceptions.RequestException) as error:
         logger.error(error)
         sys.exit(1)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if len(urls) == 1 and page_ids[0] is None:
+        sys.exit(1)
+    pages = [
+        (text, page_id) for (text, _), page_id in zip(urls, page_ids) if page_id
+    ]
+    if not pages:
+        logger.error("vktop: error: there are no valid pages to download")
+        sys.exit(1)
 
     logger.info("Downloading posts. This may take some time, be patient...")
 
-    downloader = PostDownloader(page_id, args["from"], args["to"])
+    if args["profile"]:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        # Fetching and parsing are done by workers of parallel download,
+        # they profile their tasks too
+        _profiler = profiler
 
     try:
-        if sys.version_info > (3, 0):
-            posts = downloader.parallel_fetch(args["workers"])
+        show_top(args, pages, api_options)
+    finally:
+        if args["profile"]:
+            profiler.disable()
+            save_profile(profiler, args["profile"])
+
+    if args["stats"]:
+        report_stats(args["stats"], args["stats_file"])
+
+
+def show_top(args, pages, api_options):
+    """
+    Downloads posts of (url text, page_id) pages and prints the most
+    popular ones, or exports them, according to command line arguments.
+    """
+    from .api import VKApiError
+    from .utils import pretty_print
+    from .store import PostStore
+    from .export import open_writer
+    from .live import LiveTable
+
+    sort_by = args["score"] or args["sort"] or (
+        "reposts" if args["reposts"] else "likes"
+    )
+    ranking = get_ranking(sort_by)
+
+    writer = None
+    live = LiveTable(pages, ranking, args["top"]) if args["live"] else None
+    interrupted = False
+    try:
+        if args["output"]:
+            writer = open_writer(args["output"], args["format"])
+
+        if args["db"]:
+            store = PostStore(args["db"])
+            fetch_from = [
+                store.sync_from(page_id, args["from"], args["refresh_days"])
+                for _, page_id in pages
+            ]
+            downloaders = [
+                PostDownloader(
+                    page_id,
+                    from_date,
+                    None,
+                    args["batch"],
+                    api_options,
+                    lean=args["lean"],
+                    consistent=args["consistent"],
+                )
+                for (_, page_id), from_date in zip(pages, fetch_from)
+            ]
+            results = []
+            for (_, page_id), from_date, posts in zip(
+                pages, fetch_from, download(downloaders, args)
+            ):
+                if not isinstance(posts, Exception):
+                    store.save(page_id, posts, from_date)
+                    if args["trending"]:
+                        posts = store.trending(
+                            page_id,
+                            args["top"],
+                            args["trending"],
+                            sort_by,
+                            args["from"],
+                            args["to"],
+                            match=args["match"],
+                        )
+                    else:
+                        posts = store.top(
+                            page_id,
+                            args["top"],
+                            sort_by,
+                            args["from"],
+                            args["to"],
+                            match=args["match"],
+                        )
+                results.append(posts)
+            store.close()
         else:
-            # TODO:
-            # Python 2.x does not support concurrent.futures out of the box,
-            # therefore in Python 2.x using synchronous downloading
-            if args["workers"]:
-                logger.warning("Python 2 does not support parallel downloading!")
-            posts = downloader.fetch()
-    except (KeyboardInterrupt, VKApiError, Exception) as err:
+            downloaders = [
+                PostDownloader(
+                    page_id,
+                    args["from"],
+                    args["to"],
+                    args["batch"],
+                    api_options,
+                    top=args["top"],
+                    sort_by=ranking,
+                    # Texts are needed for export only
+                    keep_text=writer is not None,
+                    lean=args["lean"],
+                    consistent=args["consistent"],
+                    match=args["match"],
+                    sink=partial(writer.write, page_id) if writer else None,
+                    progress=live.progress(slot) if live else None,
+                )
+                for slot, (_, page_id) in enumerate(pages)
+            ]
+            results = download(downloaders, args)
+    except KeyboardInterrupt as err:
+        if live is None:
+            logger.error(err)
+            sys.exit(1)
+        # Posts downloaded so far are good enough
+        results, interrupted = live.results(), True
+    except (VKApiError, Exception) as err:
         logger.error(err)
         sys.exit(1)
+    finally:
+        if writer is not None:
+            writer.close()
 
-    logger.debug("Sorting of {} posts".format(len(posts)))
+    if live is not None:
+        live.close(interrupted)
 
-    if args["reposts"]:
-        posts = sorted(posts, key=lambda x: (-x.reposts, -x.likes))
-    else:
-        posts = sorted(posts, key=lambda x: (-x.likes, -x.reposts))
+    for (text, _), posts in zip(pages, results):
+        if isinstance(posts, Exception):
+            if len(pages) == 1:
+                sys.exit(1)
+            continue
+        # Table would be mixed up with exported posts, live one is shown
+        if args["output"] == "-" or live is not None:
+            continue
+
+        logger.debug("Sorting of {} posts".format(len(posts)))
+
+        # Trending posts are ranked by the store
+        if not args["trending"]:
+            posts = rank(posts, ranking, args["top"])
 
-    pretty_print(posts[: args["top"]])
+        if len(pages) > 1:
+            print("\n{}".format(text))
+        pretty_print(posts)
+
+
+def save_profile(profiler, path):
+    """ Saves stats of 'profiler' merged with ones of worker processes """
+    import pstats
+
+    stats = pstats.Stats(profiler)
+    if _worker_stats is not None:
+        stats.add(_worker_stats)
+    stats.dump_stats(path)
+    logger.info("Profile is saved to {}".format(path))
+
+
+def report_stats(fmt, path=None):
+    """ Prints metrics of API calls or writes them to file """
+    stats = get_metrics().format(fmt)
+    if path:
+        with open(path, "w") as stats_file:
+            stats_file.write(stats)
+    else:
+        sys.stderr.write(stats + "\n")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,335 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import time
+import asyncio
+import datetime
+import logging
+
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError(
+        "async engine requires aiohttp, install it with: pip install vktop[async]"
+    )
+
+from . import constants
+from .api import VKApiError, api_params, api_result, retry_delay
+from .api import execute_code, execute_results, loads
+from .api import projection_code, projection_results
+from .tokens import get_token_pool
+from .metrics import get_metrics
+
+logger = logging.getLogger()
+
+
+def _encode(params):
+    return {key: str(value) for key, value in params.items()}
+
+
+class AsyncVKApi:
+    """
+    asyncio counterpart of api.VKApi.
+    Must be created inside of running event loop, one per loop.
+    """
+
+    def __init__(
+        self,
+        pool_size=constants.ASYNC_CONCURRENCY,
+        timeout=constants.API_TIMEOUT,
+        gzip=True,
+        max_retries=constants.API_MAX_RETRIES,
+        tokens=None,
+    ):
+        self.max_retries = max_retries
+        self.tokens = tokens
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout),
+            headers={"Accept-Encoding": "gzip, deflate" if gzip else "identity"},
+        )
+
+    async def _request(self, method, send, parse):
+        """ Sends request respecting rate limit, see api.VKApi._request """
+        tokens = self.tokens or get_token_pool()
+        metrics = get_metrics()
+        attempt = 0
+        while True:
+            index = tokens.acquire()
+            limiter = tokens.limiters[index]
+            started, size = None, 0
+            try:
+                await asyncio.sleep(limiter.reserve())
+                started = time.time()
+                async with send(tokens[index]) as response:
+                    if response.status >= 500:
+                        response.raise_for_status()
+                    body = await response.read()
+                    # Decompressed size, same as api._size
+                    size = len(body)
+                    result = parse(loads(body))
+            except (VKApiError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+                metrics.observe_request(method, started, size, error)
+                delay = retry_delay(error, attempt, self.max_retries, tokens, index)
+                if delay is None:
+                    raise
+            else:
+                metrics.observe_request(method, started, size)
+                limiter.succeeded()
+                return result
+            finally:
+                tokens.release(index)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def call(self, method, **params):
+        """ Calls API 'method' and returns its payload """
+        return await self._request(
+            method,
+            lambda token: self.session.get(
+                constants.VKAPI_URL + method, params=_encode(api_params(params, token))
+            ),
+            api_result,
+        )
+
+    async def execute(self, method, calls):
+        """ Calls API 'method' for each of 'calls' within single 'execute' request """
+        return await self.script(execute_code(method, calls), execute_results)
+
+    async def script(self, code, parse=api_result):
+        """ Runs VKScript 'code' by 'execute' request """
+        return await self._request(
+            "execute",
+            lambda token: self.session.post(
+                constants.VKAPI_URL + "execute",
+                data=_encode(api_params({"code": code}, token)),
+            ),
+            parse,
+        )
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def _request(api, downloader, pages):
+    """
+    Returns wall.get results of (offset, count) pages,
+    see PostDownloader._request_pages
+    """
+    calls = downloader._page_calls(pages)
+    if downloader.lean:
+        return await api.script(
+            projection_code(calls, constants.LEAN_FIELDS), projection_results
+        )
+    if len(calls) == 1:
+        return [await api.call("wall.get", **calls[0])]
+    return await api.execute("wall.get", calls)
+
+
+async def _request_pages(api, semaphore, downloader, pages):
+    """ Returns posts of (offset, count) pages """
+    async with semaphore:
+        results = await _request(api, downloader, pages)
+    return [downloader._page_posts(result) for result in results]
+
+
+async def _search_offset(api, semaphore, downloader, lo, hi, is_reached):
+    """ asyncio counterpart of PostDownloader._search_offset """
+    while lo < hi:
+        probes = downloader._probe_offsets(lo, hi)
+        pages = await _request_pages(
+            api, semaphore, downloader, [(offset, 1) for offset in probes]
+        )
+        lo, hi = downloader._narrow(lo, hi, probes, pages, is_reached)
+    return lo
+
+
+async def _date_window(api, semaphore, downloader, num_posts):
+    """ asyncio counterpart of PostDownloader._date_window """
+    from_date, to_date = downloader.from_date, downloader.to_date
+    if from_date == datetime.date.min and to_date == datetime.date.max:
+        return 0, num_posts, None
+
+    start, pinned = 0, None
+    first_page = (await _request_pages(api, semaphore, downloader, [(0, 1)]))[0]
+    if len(first_page) and first_page[0].is_pinned:
+        start, pinned = 1, first_page[0]
+
+    if to_date != datetime.date.max:
+        start = await _search_offset(
+            api,
+            semaphore,
+            downloader,
+            start,
+            num_posts,
+            lambda post: post.date <= to_date,
+        )
+
+    stop = num_posts
+    if from_date != datetime.date.min:
+        stop = await _search_offset(
+            api, semaphore, downloader, start, num_posts, downloader._is_before_range
+        )
+
+    logger.debug("Posts within date range: {}-{}".format(start, stop))
+    return start, stop, pinned
+
+
+async def _fetch_pages(api, semaphore, downloader, pages, cutoff):
+    """
+    Downloads (offset, count) pages, several pages per 'execute' request.
+    Pages beyond cutoff["offset"] are not requested, cutoff is moved
+    when page with posts older than 'from_date' is met.
+    Returns posts within date range, which are passed to sink right away,
+    and whether posts older than 'from_date' are reached.
+    """
+    async with semaphore:
+        if pages[0][0] > cutoff["offset"]:
+            return [], True
+        results = await _request(api, downloader, pages)
+
+    logger.debug("downloaded {} pages at offset {}".format(len(pages), pages[0][0]))
+
+    posts, reached = [], False
+    for (offset, _), result in zip(pages, results):
+        page = downloader._page_posts(result)
+        get_metrics().count("posts", value=len(page))
+        for post in page:
+            if downloader._selected(post):
+                posts.append(post)
+            elif downloader._is_before_range(post):
+                cutoff["offset"] = min(cutoff["offset"], offset)
+                reached = True
+                break
+        if reached:
+            break
+
+    if downloader.sink is not None and posts:
+        downloader.sink(posts)
+    return posts, reached
+
+
+async def _fetch(api, semaphore, downloader, window):
+    """
+    Downloads all posts of 'downloader' page, see fetch_async.
+    At most 'window' batches of pages are downloaded or wait for
+    preceding ones at a time, so memory usage does not depend on
+    size of the wall.
+    """
+    async with semaphore:
+        response = await api.call(
+            "wall.get", owner_id=downloader.page_id, offset=0, count=1
+        )
+    num_posts = response["count"]
+    logger.debug("Posts to fetch: {}".format(num_posts))
+
+    start, stop, pinned = await _date_window(api, semaphore, downloader, num_posts)
+
+    pages = list(downloader._split_pages(start, stop - start))
+    batches = [
+        pages[i : i + downloader.batch_size]
+        for i in range(0, len(pages), downloader.batch_size)
+    ]
+    cutoff = {"offset": stop}
+
+    fetched_posts = downloader._collector()
+    if pinned and downloader._selected(pinned):
+        downloader._emit([pinned], fetched_posts)
+    progress = [0, stop - start]
+    downloader._report(fetched_posts, *progress)
+
+    # Batches are added to collector in wall order up to the first one
+    # which has reached 'from_date', so early stopping works as in fetch().
+    # Batches finished ahead of their turn wait in 'finished'.
+    running, finished = {}, {}
+    next_batch, next_added, reached = 0, 0, False
+    try:
+        while not reached and next_added < len(batches):
+            while next_batch < len(batches) and next_batch - next_added < window:
+                batch = batches[next_batch]
+                task = asyncio.ensure_future(
+                    _fetch_pages(api, semaphore, downloader, batch, cutoff)
+                )
+                running[task] = next_batch
+                next_batch += 1
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                finished[running.pop(task)] = task.result()
+
+            while next_added in finished and not reached:
+                posts, reached = finished.pop(next_added)
+                fetched_posts.extend(posts)
+                progress[0] += sum(count for _, count in batches[next_added])
+                next_added += 1
+            downloader._report(
+                fetched_posts, progress[1] if reached else progress[0], progress[1]
+            )
+    finally:
+        # Page fails as a whole or has reached 'from_date', the rest of
+        # its requests are dropped
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    return downloader._posts(fetched_posts)
+
+
+async def fetch_pages_async(downloaders, concurrency=None, return_exceptions=False):
+    """
+    Downloads posts of several pages on a single event loop.
+    All pages share up to 'concurrency' requests in flight.
+    Returns list of posts (or errors if 'return_exceptions' is True)
+    for every downloader.
+    """
+    concurrency = concurrency or constants.ASYNC_CONCURRENCY
+    semaphore = asyncio.Semaphore(concurrency)
+
+    options = dict(downloaders[0].api_options, pool_size=concurrency)
+    async with AsyncVKApi(**options) as api:
+        results = await asyncio.gather(
+            *[
+                _fetch(api, semaphore, downloader, concurrency)
+                for downloader in downloaders
+            ],
+            return_exceptions=return_exceptions
+        )
+
+    for downloader, result in zip(downloaders, results):
+        if isinstance(result, Exception):
+            logger.error("Page {}: {}".format(downloader.page_id, result))
+    return results
+
+
+async def fetch_async(downloader, concurrency=None):
+    """
+    Downloads all posts of 'downloader' page on a single event loop.
+    Returns the same posts as PostDownloader.fetch().
+    """
+    return (await fetch_pages_async([downloader], concurrency))[0]
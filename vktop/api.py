@@ -0,0 +1,302 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import json
+import time
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import constants
+from .ratelimit import backoff_delay
+from .tokens import get_token_pool
+from .metrics import get_metrics
+
+# Faster JSON decoders are used when installed, results are the same
+try:
+    from orjson import loads
+except ImportError:
+    try:
+        from ujson import loads
+    except ImportError:
+        from json import loads
+
+logger = logging.getLogger()
+
+# VK API error codes of failures which may pass on retry
+UNKNOWN_ERROR = 1
+TOO_MANY_REQUESTS = 6
+FLOOD_CONTROL = 9
+INTERNAL_SERVER_ERROR = 10
+# Error codes of failures caused by access token
+AUTHORIZATION_FAILED = 5
+APP_AUTHORIZATION_FAILED = 28
+RATE_LIMIT_REACHED = 29
+
+RETRY_ERROR_CODES = (
+    UNKNOWN_ERROR,
+    TOO_MANY_REQUESTS,
+    FLOOD_CONTROL,
+    INTERNAL_SERVER_ERROR,
+)
+THROTTLE_ERROR_CODES = (TOO_MANY_REQUESTS, FLOOD_CONTROL)
+# Seconds token is suspended for after error caused by it
+TOKEN_COOLDOWNS = {
+    TOO_MANY_REQUESTS: constants.TOKEN_THROTTLED_COOLDOWN,
+    FLOOD_CONTROL: constants.TOKEN_THROTTLED_COOLDOWN,
+    RATE_LIMIT_REACHED: constants.TOKEN_EXHAUSTED_COOLDOWN,
+    AUTHORIZATION_FAILED: constants.TOKEN_REVOKED_COOLDOWN,
+    APP_AUTHORIZATION_FAILED: constants.TOKEN_REVOKED_COOLDOWN,
+}
+
+
+class VKApiError(RuntimeError):
+    def __init__(self, message, code=None):
+        super(VKApiError, self).__init__(message)
+        self.code = code
+
+
+def api_params(params, access_token):
+    """ Returns request parameters completed with API version and access token """
+    params = dict(params)
+    params.setdefault("v", constants.VKAPI_VERSION)
+    params.setdefault("access_token", access_token)
+    return params
+
+
+def api_result(response):
+    """ Returns payload of API response or raises VKApiError """
+    if "error" in response:
+        error = response["error"]
+        raise VKApiError(error["error_msg"], error.get("error_code"))
+    return response["response"]
+
+
+def execute_code(method, calls):
+    """ Returns VKScript code of 'execute' request calling 'method' for each of 'calls' """
+    return "return [{}];".format(
+        ",".join(
+            "API.{}({})".format(method, json.dumps(params, sort_keys=True))
+            for params in calls
+        )
+    )
+
+
+def execute_results(response):
+    """ Splits 'execute' response back into results of separate calls """
+    results = api_result(response)
+    # Failed calls return false, while empty result is a valid one
+    if any(result is False for result in results):
+        errors = response.get("execute_errors") or [{"error_msg": "execute failed"}]
+        raise VKApiError(errors[0]["error_msg"], errors[0].get("error_code"))
+    return results
+
+
+def projection_code(calls, fields):
+    """
+    Returns VKScript code of 'execute' request calling wall.get for each
+    of 'calls' and keeping only 'fields' of posts, every field is returned
+    as a column, e.g. {"id": [...], "likes": [...]}.
+    Nested fields are given as paths like 'likes.count'.
+    """
+    code = []
+    for i, params in enumerate(calls):
+        code.append(
+            "var r{} = API.wall.get({});".format(i, json.dumps(params, sort_keys=True))
+        )
+    columns = [
+        ",".join(
+            '"{}":r{}.items@.{}'.format(
+                field.split(".")[0], i, field.replace(".", "@.")
+            )
+            for field in fields
+        )
+        for i in range(len(calls))
+    ]
+    code.append("return [{}];".format(",".join("{" + c + "}" for c in columns)))
+    return "".join(code)
+
+
+def projection_results(response):
+    """ Splits response of projection_code request into columns of every call """
+    results = api_result(response)
+    # Columns of failed call are nulls instead of lists
+    if any(
+        not isinstance(result, dict) or None in result.values() for result in results
+    ):
+        errors = response.get("execute_errors") or [{"error_msg": "execute failed"}]
+        raise VKApiError(errors[0]["error_msg"], errors[0].get("error_code"))
+    return results
+
+
+def retry_delay(error, attempt, max_retries, tokens, index):
+    """
+    Decides whether request made with token 'index' of 'tokens' pool and
+    failed with 'error' should be retried. Token is suspended if the error
+    is caused by it. Request of revoked or exhausted token is retried at
+    once with another token, throttled one backs off as usual.
+    Returns backoff delay in seconds or None if error must be raised.
+    """
+    switch = False
+    if isinstance(error, VKApiError) and error.code in TOKEN_COOLDOWNS:
+        tokens.suspend(index, TOKEN_COOLDOWNS[error.code])
+        get_metrics().count("suspended")
+        if error.code in THROTTLE_ERROR_CODES:
+            tokens.limiters[index].throttled()
+            get_metrics().count("throttled")
+        else:
+            switch = tokens.available()
+
+    if attempt >= max_retries:
+        return None
+    if isinstance(error, VKApiError) and not switch:
+        if error.code not in RETRY_ERROR_CODES:
+            return None
+
+    get_metrics().count("retries")
+    delay = 0.0 if switch else backoff_delay(attempt)
+    logger.debug("{!r}, retrying in {:.1f}s".format(error, delay))
+    return delay
+
+
+def _size(response):
+    """
+    Returns number of bytes of decompressed response body, Content-Length
+    is size of compressed one and is missing in chunked responses
+    """
+    if response is None:
+        return 0
+    return len(response.content)
+
+
+class VKApi:
+    """ VK API client, keeps pooled keep-alive connections between calls """
+
+    def __init__(
+        self,
+        pool_size=constants.API_POOL_SIZE,
+        timeout=constants.API_TIMEOUT,
+        gzip=True,
+        max_retries=constants.API_MAX_RETRIES,
+        tokens=None,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # Process-wide token pool is used unless other one is given
+        self.tokens = tokens
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate" if gzip else "identity"
+
+    def _request(self, method, send, parse):
+        """
+        Sends request of API 'method' built by 'send' callable, which takes
+        access token, respecting rate limit of the token and returns its
+        response decoded by 'parse'.
+        Throttled and transient failures are retried with exponential backoff.
+        """
+        tokens = self.tokens or get_token_pool()
+        metrics = get_metrics()
+        attempt = 0
+        while True:
+            index = tokens.acquire()
+            limiter = tokens.limiters[index]
+            limiter.wait()
+            started, response = time.time(), None
+            try:
+                response = send(tokens[index])
+                if response.status_code >= 500:
+                    response.raise_for_status()
+                result = parse(loads(response.content))
+            except (
+                VKApiError,
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.HTTPError,
+            ) as error:
+                metrics.observe_request(method, started, _size(response), error)
+                delay = retry_delay(error, attempt, self.max_retries, tokens, index)
+                if delay is None:
+                    raise
+            else:
+                metrics.observe_request(method, started, _size(response))
+                limiter.succeeded()
+                return result
+            finally:
+                tokens.release(index)
+            time.sleep(delay)
+            attempt += 1
+
+    def call(self, method, **params):
+        """ Calls API 'method' and returns its payload """
+        return self._request(
+            method,
+            lambda token: self.session.get(
+                constants.VKAPI_URL + method,
+                params=api_params(params, token),
+                timeout=self.timeout,
+            ),
+            api_result,
+        )
+
+    def execute(self, method, calls):
+        """
+        Calls API 'method' once for each parameters dict of 'calls'
+        within a single 'execute' request. Returns list of payloads.
+        """
+        return self.script(execute_code(method, calls), execute_results)
+
+    def script(self, code, parse=api_result):
+        """ Runs VKScript 'code' by 'execute' and returns response decoded by 'parse' """
+        return self._request(
+            "execute",
+            lambda token: self.session.post(
+                constants.VKAPI_URL + "execute",
+                data=api_params({"code": code}, token),
+                timeout=self.timeout,
+            ),
+            parse,
+        )
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+
+
+def get_client(**options):
+    """
+    Returns VKApi client shared by all callers with the same 'options'.
+    Every process gets its own client, connections are never shared
+    between forked workers.
+    """
+    key = (os.getpid(), tuple(sorted(options.items())))
+    if key not in _clients:
+        _clients[key] = VKApi(**options)
+    return _clients[key]
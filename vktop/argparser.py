@@ -25,23 +25,28 @@ import textwrap
 import datetime
 
 from . import constants, __version__ as app_version
+from .ranking import RANKINGS, Score
+from .tokens import STRATEGIES, ROUND_ROBIN
+from .search import Query
 
 
 def url_validator(arg):
     """ Check correctness of url argument """
-    arg = arg.lower()
+    text, arg = arg, arg.lower()
 
     # If url looks like http[s]://vk.com/domain
     symbolic_id = constants.TXT_ID_REGEXP.match(arg)
     if symbolic_id:
         url = symbolic_id.groupdict()
         url["type"] = "domain"
+        url["text"] = text
         return url
 
     # If url looks like http[s]://vk.com/id123456
     numeric_id = constants.NUM_ID_REGEXP.match(arg)
     if numeric_id:
         url = numeric_id.groupdict()
+        url["text"] = text
         return url
 
     raise argparse.ArgumentTypeError("{} - invalid url address".format(arg))
@@ -56,6 +61,46 @@ def pos_int_validator(arg):
         raise argparse.ArgumentTypeError("{} - must be a positive number".format(arg))
 
 
+def pos_float_validator(arg):
+    """ Check that number is positive """
+    try:
+        num = float(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} - must be a number".format(arg))
+    if num > 0:
+        return num
+    else:
+        raise argparse.ArgumentTypeError("{} - must be a positive number".format(arg))
+
+
+def batch_validator(arg):
+    """ Check that batch size fits into a single 'execute' request """
+    num = pos_int_validator(arg)
+    if num <= constants.EXECUTE_MAX_CALLS:
+        return num
+    else:
+        raise argparse.ArgumentTypeError(
+            "{} - must not be greater than {}".format(arg, constants.EXECUTE_MAX_CALLS)
+        )
+
+
+def score_validator(arg):
+    """ Check that score expression is valid """
+    try:
+        Score(arg)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return arg
+
+
+def match_validator(arg):
+    """ Check that search query has words to match """
+    try:
+        return Query(arg)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
 def date_validator(arg):
     try:
         date = datetime.datetime.strptime(arg.replace(".", "-"), "%d-%m-%Y").date()
@@ -70,12 +115,14 @@ def parse_args():
     app_description = textwrap.dedent(
         """
   VK-Top is used for getting popular posts of any public available page at VK.com
-  Project repository: https://github.com/yutkin/VK-Top"""
+  Project repository: https://github.com/yutkin/VK-Top
+  Run 'vktop serve --help' for HTTP server mode and 'vktop coordinator --help'
+  for download spread over several hosts"""
     )
 
     parser = argparse.ArgumentParser(
         prog="vktop",
-        usage="vktop <url> [options]",
+        usage="vktop (<url> | -i <file>) [options]",
         description=app_description,
         formatter_class=argparse.RawTextHelpFormatter,
     )
@@ -100,11 +147,27 @@ def parse_args():
     parser.add_argument(
         "url",
         action="store",
+        nargs="?",
         default=None,
         help=url_param_description,
         type=url_validator,
     )
 
+    parser.add_argument(
+        "-i",
+        "--input",
+        action="store",
+        default=None,
+        metavar="<file>",
+        help=textwrap.dedent(
+            """\
+                      read target pages from <file>, one <url> per line,
+                      '-' reads them from stdin. All pages are downloaded
+                      by the same workers and top posts are printed for
+                      every page"""
+        ),
+    )
+
     compar_key = parser.add_mutually_exclusive_group()
 
     compar_key.add_argument(
@@ -123,6 +186,35 @@ def parse_args():
         default=False,
     )
 
+    compar_key.add_argument(
+        "-s",
+        "--sort",
+        choices=sorted(RANKINGS),
+        default=None,
+        metavar="<metric>",
+        help=textwrap.dedent(
+            """\
+                      sort posts by metric: likes, reposts, comments,
+                      views, engagement, likes_per_day, reposts_per_day
+                      engagement - (likes + reposts + comments) / views
+                      *_per_day  - counter divided by age in days"""
+        ),
+    )
+
+    compar_key.add_argument(
+        "--score",
+        default=None,
+        metavar="<expr>",
+        type=score_validator,
+        help=textwrap.dedent(
+            """\
+                      sort posts by score expression of likes, reposts,
+                      comments, views and age (days since publication)
+                      with + - * / and sqrt, log1p, abs, min, max,
+                      e.g. 'log1p(likes) + 2 * reposts / age'"""
+        ),
+    )
+
     parser.add_argument(
         "-n",
         "--top",
@@ -146,6 +238,116 @@ def parse_args():
         type=pos_int_validator,
     )
 
+    parser.add_argument(
+        "-b",
+        "--batch",
+        metavar="<number>",
+        help=textwrap.dedent(
+            """\
+                      number of pages (100 posts each) requested per
+                      single HTTP request, up to 25 (default: 1)"""
+        ),
+        default=1,
+        type=batch_validator,
+    )
+
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=["process", "async"],
+        default="process",
+        help=textwrap.dedent(
+            """\
+                      download engine (default: process)
+                      process - one OS process per worker
+                      async   - asyncio event loop, <number> of workers
+                                is a number of pages in flight
+                                (requires Python 3 and aiohttp)"""
+        ),
+    )
+
+    parser.add_argument(
+        "--lean",
+        action="store_true",
+        default=False,
+        help=textwrap.dedent(
+            """\
+                      request only id, date, likes, reposts, comments,
+                      views and pin flag of posts, which makes API
+                      responses several times smaller (posts texts are
+                      not stored)"""
+        ),
+    )
+
+    parser.add_argument(
+        "--consistent",
+        action="store_true",
+        default=False,
+        help=textwrap.dedent(
+            """\
+                      download the wall as it was when download started,
+                      without duplicated or skipped posts, though posts
+                      are published or deleted meanwhile (process
+                      engine only)"""
+        ),
+    )
+
+    parser.add_argument(
+        "--timeout",
+        metavar="<seconds>",
+        help=textwrap.dedent(
+            """\
+                      seconds to wait for API response (default: {})""".format(
+                constants.API_TIMEOUT
+            )
+        ),
+        default=constants.API_TIMEOUT,
+        type=pos_float_validator,
+    )
+
+    parser.add_argument(
+        "--rate",
+        metavar="<number>",
+        help=textwrap.dedent(
+            """\
+                      max number of API requests per second of every
+                      access token shared by all workers, lowered
+                      automatically when API reports too many requests
+                      (default: {})""".format(
+                constants.API_MAX_RPS
+            )
+        ),
+        default=constants.API_MAX_RPS,
+        type=pos_float_validator,
+    )
+
+    parser.add_argument(
+        "--tokens",
+        metavar="<file>",
+        default=None,
+        help=textwrap.dedent(
+            """\
+                      read access tokens from file, one per line;
+                      otherwise they are taken from VKTOP_TOKENS
+                      environment variable or ~/.config/vktop/tokens,
+                      requests are spread across all of them"""
+        ),
+    )
+
+    parser.add_argument(
+        "--token-strategy",
+        choices=STRATEGIES,
+        default=ROUND_ROBIN,
+        help=textwrap.dedent(
+            """\
+                      how tokens are picked for requests: in turn or
+                      the one with the fewest requests in flight
+                      (default: {})""".format(
+                ROUND_ROBIN
+            )
+        ),
+    )
+
     parser.add_argument(
         "-f",
         "--from",
@@ -185,6 +387,146 @@ def parse_args():
         ),
     )
 
+    parser.add_argument(
+        "--match",
+        action="store",
+        type=match_validator,
+        default=None,
+        metavar="<terms>",
+        help=textwrap.dedent(
+            """\
+                      keep posts whose text contains all of words
+                      <terms>, case and 'ё' insensitive; word ending
+                      with * matches words starting with it, e.g.
+                      'москв*'; with --db, stored posts are searched
+                      by index"""
+        ),
+    )
+
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        default=False,
+        help=textwrap.dedent(
+            """\
+                      redraw top posts with progress while downloading,
+                      Ctrl-C stops and shows posts downloaded so far"""
+        ),
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        default=None,
+        metavar="<path>",
+        help=textwrap.dedent(
+            """\
+                      write all downloaded posts to <path> ('-' is
+                      stdout) while downloading, format is chosen by
+                      extension: .ndjson, .jsonl, .csv or .parquet
+                      (requires pyarrow)"""
+        ),
+    )
+
+    parser.add_argument(
+        "--format",
+        choices=["ndjson", "csv", "parquet"],
+        default=None,
+        help=textwrap.dedent(
+            """\
+                      format of --output file regardless of extension"""
+        ),
+    )
+
+    parser.add_argument(
+        "--db",
+        action="store",
+        default=None,
+        metavar="<path>",
+        help=textwrap.dedent(
+            """\
+                      keep posts in SQLite database <path> and download
+                      only new posts on subsequent runs"""
+        ),
+    )
+
+    parser.add_argument(
+        "--refresh-days",
+        action="store",
+        type=pos_int_validator,
+        default=constants.REFRESH_DAYS,
+        metavar="<number>",
+        help=textwrap.dedent(
+            """\
+                      with --db, update likes and reposts of posts
+                      published last <number> days (default: {})""".format(
+                constants.REFRESH_DAYS
+            )
+        ),
+    )
+
+    parser.add_argument(
+        "--trending",
+        action="store",
+        type=pos_float_validator,
+        default=None,
+        metavar="<hours>",
+        help=textwrap.dedent(
+            """\
+                      with --db, sort posts by growth of likes (or
+                      reposts with --reposts) per hour within last
+                      <hours>, measured between runs of vktop; young
+                      posts need less growth to trend"""
+        ),
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help=textwrap.dedent(
+            """\
+                      do not use cache of resolved page names"""
+        ),
+    )
+
+    parser.add_argument(
+        "--stats",
+        nargs="?",
+        const="text",
+        default=None,
+        choices=["text", "json", "prometheus"],
+        help=textwrap.dedent(
+            """\
+                      print statistics of API requests: latency,
+                      errors, retries, busy and idle time of workers"""
+        ),
+    )
+
+    parser.add_argument(
+        "--stats-file",
+        action="store",
+        default=None,
+        metavar="<path>",
+        help=textwrap.dedent(
+            """\
+                      write --stats to <path> instead of stderr"""
+        ),
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store",
+        default=None,
+        metavar="<path>",
+        help=textwrap.dedent(
+            """\
+                      save cProfile data of the main process merged
+                      with the one of download workers to <path>"""
+        ),
+    )
+
     parser.add_argument(
         "--verbose",
         action="store_true",
@@ -195,3 +537,393 @@ def parse_args():
         ),
     )
     return parser.parse_args()
+
+
+def parse_serve_args(argv=None):
+    """ Parses arguments of 'vktop serve' """
+
+    parser = argparse.ArgumentParser(
+        prog="vktop serve",
+        usage="vktop serve [<url> ...] [-i <file>] [options]",
+        description=textwrap.dedent(
+            """
+  Keeps posts of tracked pages in memory, refreshes them in background and
+  answers queries like GET /top?page=<url>&n=10&sort=likes&from=<date>&to=<date>
+  Pages are tracked from the start or since their first query."""
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser._optionals.title = "Options"
+    parser._positionals.title = "Parameters"
+
+    parser.add_argument(
+        "urls", metavar="<url>", nargs="*", type=url_validator, help="tracked pages"
+    )
+
+    parser.add_argument(
+        "-i",
+        "--input",
+        action="store",
+        default=None,
+        metavar="<file>",
+        help=textwrap.dedent(
+            """\
+                      read tracked pages from file, one url per line"""
+        ),
+    )
+
+    parser.add_argument(
+        "--host",
+        default=constants.SERVE_HOST,
+        metavar="<host>",
+        help="address to listen on (default: {})".format(constants.SERVE_HOST),
+    )
+
+    parser.add_argument(
+        "--port",
+        default=constants.SERVE_PORT,
+        metavar="<port>",
+        type=int,
+        help="port to listen on (default: {})".format(constants.SERVE_PORT),
+    )
+
+    parser.add_argument(
+        "--interval",
+        metavar="<seconds>",
+        help=textwrap.dedent(
+            """\
+                      seconds between refreshes of a page (default: {})""".format(
+                constants.SERVE_INTERVAL
+            )
+        ),
+        default=constants.SERVE_INTERVAL,
+        type=pos_float_validator,
+    )
+
+    parser.add_argument(
+        "--refreshes",
+        metavar="<number>",
+        help=textwrap.dedent(
+            """\
+                      pages refreshed at the same time (default: {})""".format(
+                constants.SERVE_REFRESHES
+            )
+        ),
+        default=constants.SERVE_REFRESHES,
+        type=pos_int_validator,
+    )
+
+    parser.add_argument(
+        "-d",
+        "--days",
+        metavar="<number>",
+        help=textwrap.dedent(
+            """\
+                      keep posts published within last <number> days
+                      only (default: whole wall)"""
+        ),
+        default=None,
+        type=pos_int_validator,
+    )
+
+    parser.add_argument(
+        "-b",
+        "--batch",
+        metavar="<number>",
+        help=textwrap.dedent(
+            """\
+                      number of pages (100 posts each) requested per
+                      single HTTP request, up to 25 (default: 1)"""
+        ),
+        default=1,
+        type=batch_validator,
+    )
+
+    parser.add_argument(
+        "--lean",
+        action="store_true",
+        default=False,
+        help="request only fields needed for ranking, see vktop --help",
+    )
+
+    parser.add_argument(
+        "--timeout",
+        metavar="<seconds>",
+        help="seconds to wait for API response (default: {})".format(
+            constants.API_TIMEOUT
+        ),
+        default=constants.API_TIMEOUT,
+        type=pos_float_validator,
+    )
+
+    parser.add_argument(
+        "--rate",
+        metavar="<number>",
+        help=textwrap.dedent(
+            """\
+                      max number of API requests per second of every
+                      access token shared by all refreshes (default: {})""".format(
+                constants.API_MAX_RPS
+            )
+        ),
+        default=constants.API_MAX_RPS,
+        type=pos_float_validator,
+    )
+
+    parser.add_argument(
+        "--tokens",
+        metavar="<file>",
+        default=None,
+        help="read access tokens from file, see vktop --help",
+    )
+
+    parser.add_argument(
+        "--token-strategy",
+        choices=STRATEGIES,
+        default=ROUND_ROBIN,
+        help="how tokens are picked for requests (default: {})".format(ROUND_ROBIN),
+    )
+
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="do not use cache of resolved page names",
+    )
+
+    parser.add_argument(
+        "--verbose", action="store_true", default=False, help="print debug messages"
+    )
+    return parser.parse_args(argv)
+
+
+def parse_coordinator_args(argv=None):
+    """ Parses arguments of 'vktop coordinator' """
+
+    parser = argparse.ArgumentParser(
+        prog="vktop coordinator",
+        usage="vktop coordinator (<url> ... | -i <file>) [options]",
+        description=textwrap.dedent(
+            """
+  Splits download of pages into tasks and leases them to 'vktop worker'
+  processes, possibly running on other hosts with their own access tokens.
+  Tasks of workers which stopped sending heartbeats are leased again.
+  Prints top posts of every page once all of them are downloaded."""
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser._optionals.title = "Options"
+    parser._positionals.title = "Parameters"
+
+    parser.add_argument(
+        "urls", metavar="<url>", nargs="*", type=url_validator, help="target pages"
+    )
+
+    parser.add_argument(
+        "-i",
+        "--input",
+        action="store",
+        default=None,
+        metavar="<file>",
+        help=textwrap.dedent(
+            """\
+                      read target pages from file, one url per line"""
+        ),
+    )
+
+    sort_key = parser.add_mutually_exclusive_group()
+
+    sort_key.add_argument(
+        "-s",
+        "--sort",
+        choices=sorted(RANKINGS),
+        default=None,
+        metavar="<metric>",
+        help="sort posts by metric, see vktop --help (default: likes)",
+    )
+
+    sort_key.add_argument(
+        "--score",
+        default=None,
+        metavar="<expr>",
+        type=score_validator,
+        help="sort posts by score expression, see vktop --help",
+    )
+
+    parser.add_argument(
+        "-n",
+        "--top",
+        help="number of posts to show",
+        default=10,
+        metavar="<number>",
+        type=pos_int_validator,
+    )
+
+    parser.add_argument(
+        "-f",
+        "--from",
+        dest="from_date",
+        type=date_validator,
+        default=None,
+        metavar="<date>",
+        help="discard posts published before this date",
+    )
+
+    parser.add_argument(
+        "-t",
+        "--to",
+        dest="to_date",
+        type=date_validator,
+        default=None,
+        metavar="<date>",
+        help="discard posts published after this date",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--days",
+        type=pos_int_validator,
+        default=None,
+        metavar="<number>",
+        help="discard posts published <number> days ago",
+    )
+
+    parser.add_argument(
+        "--match",
+        type=match_validator,
+        default=None,
+        metavar="<terms>",
+        help="keep posts whose text contains all of words <terms>",
+    )
+
+    parser.add_argument(
+        "-b",
+        "--batch",
+        metavar="<number>",
+        help=textwrap.dedent(
+            """\
+                      number of pages (100 posts each) requested per
+                      single HTTP request, up to 25 (default: 1)"""
+        ),
+        default=1,
+        type=batch_validator,
+    )
+
+    parser.add_argument(
+        "--lean",
+        action="store_true",
+        default=False,
+        help="request only fields needed for ranking, see vktop --help",
+    )
+
+    parser.add_argument(
+        "--host",
+        default=constants.CLUSTER_HOST,
+        metavar="<host>",
+        help=textwrap.dedent(
+            """\
+                      address to listen on, use 0.0.0.0 for workers
+                      on other hosts (default: {})""".format(
+                constants.CLUSTER_HOST
+            )
+        ),
+    )
+
+    parser.add_argument(
+        "--port",
+        default=constants.CLUSTER_PORT,
+        metavar="<port>",
+        type=int,
+        help="port to listen on (default: {})".format(constants.CLUSTER_PORT),
+    )
+
+    parser.add_argument(
+        "--lease-timeout",
+        metavar="<seconds>",
+        help=textwrap.dedent(
+            """\
+                      seconds a task stays leased to a worker without
+                      its heartbeats (default: {})""".format(
+                constants.CLUSTER_LEASE_TIMEOUT
+            )
+        ),
+        default=constants.CLUSTER_LEASE_TIMEOUT,
+        type=pos_float_validator,
+    )
+
+    parser.add_argument(
+        "--verbose", action="store_true", default=False, help="print debug messages"
+    )
+    return parser.parse_args(argv)
+
+
+def parse_worker_args(argv=None):
+    """ Parses arguments of 'vktop worker' """
+
+    parser = argparse.ArgumentParser(
+        prog="vktop worker",
+        usage="vktop worker <coordinator> [options]",
+        description=textwrap.dedent(
+            """
+  Downloads tasks leased by 'vktop coordinator' until all pages are done.
+  Several workers may run on one host, they share nothing but the
+  coordinator, so every one of them has its own --rate limits."""
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser._optionals.title = "Options"
+    parser._positionals.title = "Parameters"
+
+    parser.add_argument(
+        "coordinator",
+        metavar="<coordinator>",
+        help="address of coordinator, e.g. http://10.0.0.1:{}".format(
+            constants.CLUSTER_PORT
+        ),
+    )
+
+    parser.add_argument(
+        "--timeout",
+        metavar="<seconds>",
+        help="seconds to wait for API response (default: {})".format(
+            constants.API_TIMEOUT
+        ),
+        default=constants.API_TIMEOUT,
+        type=pos_float_validator,
+    )
+
+    parser.add_argument(
+        "--rate",
+        metavar="<number>",
+        help=textwrap.dedent(
+            """\
+                      max number of API requests per second of every
+                      access token (default: {})""".format(
+                constants.API_MAX_RPS
+            )
+        ),
+        default=constants.API_MAX_RPS,
+        type=pos_float_validator,
+    )
+
+    parser.add_argument(
+        "--tokens",
+        metavar="<file>",
+        default=None,
+        help="read access tokens from file, see vktop --help",
+    )
+
+    parser.add_argument(
+        "--token-strategy",
+        choices=STRATEGIES,
+        default=ROUND_ROBIN,
+        help="how tokens are picked for requests (default: {})".format(ROUND_ROBIN),
+    )
+
+    parser.add_argument(
+        "--verbose", action="store_true", default=False, help="print debug messages"
+    )
+    return parser.parse_args(argv)
@@ -0,0 +1,546 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+'vktop coordinator' and 'vktop worker': download of many pages spread
+over several hosts, each with its own access tokens and rate limits.
+
+Coordinator splits pages into tasks, same as parallel_fetch_pages, and
+leases them to workers over HTTP. Every worker asks for a task, sends
+heartbeats while downloading it and returns top posts of the task:
+
+    POST /lease      {"worker": name}       -> {"lease": {...}}, {"wait": seconds}
+                                               or {"done": true}
+    POST /heartbeat  {"lease": id}          -> {"ok": false} if lease is lost
+    POST /complete   {"lease": id, "result": {...}}
+    POST /fail       {"lease": id, "error": message}
+
+Lease expires unless heartbeats come in time, then its task is leased
+again, and results of lost leases are ignored.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import datetime
+import itertools
+import threading
+from collections import deque
+
+import requests
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from . import constants
+from .post import Post
+from .ranking import TopN, get_ranking
+from .search import Query
+from .tokens import TokenPool, load_tokens, set_token_pool
+from .utils import read_urls
+
+logger = logging.getLogger()
+
+
+def _post_json(post):
+    return {
+        "id": post.id,
+        "date": post.date.isoformat(),
+        "likes": post.likes,
+        "reposts": post.reposts,
+        "comments": post.comments,
+        "views": post.views,
+        "is_pinned": post.is_pinned,
+        "text": post.text,
+    }
+
+
+def _json_post(data, page_id):
+    return Post(
+        id=data["id"],
+        likes=data["likes"],
+        reposts=data["reposts"],
+        date=_parse_date(data["date"]),
+        text=data["text"],
+        is_pinned=data["is_pinned"],
+        page_id=page_id,
+        comments=data["comments"],
+        views=data["views"],
+    )
+
+
+def _parse_date(text):
+    if text is None:
+        return None
+    return datetime.datetime.strptime(text, "%Y-%m-%d").date()
+
+
+class Coordinator(object):
+    """
+    Leases tasks of downloading pages to workers and merges their results.
+    'job' is options of download shared by all workers, see run_task.
+    """
+
+    def __init__(self, urls, job, lease_timeout=constants.CLUSTER_LEASE_TIMEOUT):
+        # Parsed urls of pages, see argparser.url_validator
+        self.urls = urls
+        self.job = job
+        self.lease_timeout = lease_timeout
+        key = get_ranking(job["sort"]).key
+        self.results = [TopN(job["top"], key) for _ in urls]
+        self.errors = [None for _ in urls]
+        self.page_ids = [None for _ in urls]
+        # Offsets of pages where posts become older than the date range
+        self.cutoffs = [sys.maxsize for _ in urls]
+
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        # (slot, offset, count, attempt) of tasks waiting for a worker,
+        # task without offset finds out which posts of the page to download
+        self._tasks = deque((slot, None, None, 0) for slot in range(len(urls)))
+        # Lease id -> [task, worker, deadline]
+        self._leases = {}
+        self._lease_ids = itertools.count(1)
+        # Workers which have not been told that download is finished
+        self._workers = set()
+        self._check_finished()
+
+    def lease(self, worker):
+        """ Returns reply to worker asking for a task """
+        with self._lock:
+            self._expire()
+            if self._finished.is_set():
+                self._workers.discard(worker)
+                return {"done": True}
+            self._workers.add(worker)
+
+            while self._tasks:
+                task = self._tasks.popleft()
+                slot, offset = task[:2]
+                if self.errors[slot] is None and (
+                    offset is None or offset <= self.cutoffs[slot]
+                ):
+                    break
+            else:
+                return {"wait": constants.CLUSTER_POLL_INTERVAL}
+
+            lease_id = next(self._lease_ids)
+            self._leases[lease_id] = [task, worker, time.time() + self.lease_timeout]
+            slot, offset, count, _ = task
+            return {
+                "lease": {
+                    "id": lease_id,
+                    "url": self.urls[slot],
+                    "page_id": self.page_ids[slot],
+                    "offset": offset,
+                    "count": count,
+                    "job": self.job,
+                    "timeout": self.lease_timeout,
+                }
+            }
+
+    def heartbeat(self, lease_id):
+        """ Prolongs the lease, returns False if it is lost """
+        with self._lock:
+            if lease_id not in self._leases:
+                return False
+            self._leases[lease_id][2] = time.time() + self.lease_timeout
+            return True
+
+    def complete(self, lease_id, result):
+        """ Takes result of leased task, returns False if the lease is lost """
+        with self._lock:
+            lease = self._leases.pop(lease_id, None)
+            if lease is None:
+                return False
+            slot, offset, _, _ = lease[0]
+            if offset is None:
+                self._planned(slot, result)
+            else:
+                self.results[slot].extend(
+                    _json_post(post, self.page_ids[slot]) for post in result["posts"]
+                )
+                boundary = result["boundary"]
+                if boundary is not None and boundary < self.cutoffs[slot]:
+                    logger.debug(
+                        "Page {} posts beyond offset {} are too old".format(
+                            self.page_ids[slot], boundary
+                        )
+                    )
+                    self._cancel(slot, boundary)
+            self._check_finished()
+            return True
+
+    def fail(self, lease_id, error):
+        """ Puts task of failed lease back to the queue or gives the page up """
+        with self._lock:
+            lease = self._leases.pop(lease_id, None)
+            if lease is None:
+                return False
+            (slot, offset, count, attempt), worker = lease[:2]
+            if attempt < constants.CHUNK_RETRIES:
+                logger.warning(
+                    "Page {} {} failed on {} ({}), retrying".format(
+                        self.urls[slot]["text"],
+                        "counting"
+                        if offset is None
+                        else "posts {}-{}".format(offset, offset + count),
+                        worker,
+                        error,
+                    )
+                )
+                self._tasks.append((slot, offset, count, attempt + 1))
+            else:
+                self._give_up(slot, error)
+            self._check_finished()
+            return True
+
+    def wait(self, timeout=None):
+        """ Waits until all pages are downloaded, returns False on timeout """
+        return self._finished.wait(timeout)
+
+    def wait_workers(self, timeout):
+        """ Waits until all workers are told that download is finished """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                if not self._workers:
+                    return True
+            time.sleep(0.1)
+        return False
+
+    def _planned(self, slot, result):
+        """ Puts tasks downloading the page given result of its planning """
+        page_id = result["page_id"]
+        if page_id is None:
+            self._give_up(
+                slot, "Troubles with resolving {} id".format(self.urls[slot]["id"])
+            )
+            return
+        self.page_ids[slot] = page_id
+        self.cutoffs[slot] = result["stop"]
+        if result["pinned"] is not None:
+            self.results[slot].append(_json_post(result["pinned"], page_id))
+        self._tasks.extend(
+            (slot, offset, count, 0) for offset, count in result["chunks"]
+        )
+        logger.debug(
+            "Page {} is split into {} tasks".format(page_id, len(result["chunks"]))
+        )
+
+    def _give_up(self, slot, error):
+        logger.error("Page {}: {}".format(self.urls[slot]["text"], error))
+        self.errors[slot] = error
+        self._cancel(slot)
+
+    def _cancel(self, slot, boundary=-1):
+        """ Cancels tasks and leases of the page beyond 'boundary' offset """
+
+        def cancelled(task):
+            return task[0] == slot and (task[1] is None or task[1] > boundary)
+
+        self.cutoffs[slot] = boundary
+        tasks_left = [task for task in self._tasks if not cancelled(task)]
+        self._tasks.clear()
+        self._tasks.extend(tasks_left)
+        for lease_id, (task, _, _) in list(self._leases.items()):
+            if cancelled(task):
+                del self._leases[lease_id]
+
+    def _expire(self):
+        """ Puts tasks of leases without recent heartbeats back to the queue """
+        now = time.time()
+        for lease_id, (task, worker, deadline) in list(self._leases.items()):
+            if deadline < now:
+                logger.warning(
+                    "Lease {} of {} has expired, leasing its task again".format(
+                        lease_id, worker
+                    )
+                )
+                del self._leases[lease_id]
+                self._tasks.appendleft(task)
+
+    def _check_finished(self):
+        if not self._tasks and not self._leases:
+            self._finished.set()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(coordinator, host=constants.CLUSTER_HOST, port=constants.CLUSTER_PORT):
+    """ Returns HTTP server leasing tasks of 'coordinator' to workers """
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            logger.debug(fmt % args)
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length).decode("utf-8"))
+                if self.path == "/lease":
+                    reply = coordinator.lease(body["worker"])
+                elif self.path == "/heartbeat":
+                    reply = {"ok": coordinator.heartbeat(body["lease"])}
+                elif self.path == "/complete":
+                    reply = {"ok": coordinator.complete(body["lease"], body["result"])}
+                elif self.path == "/fail":
+                    reply = {"ok": coordinator.fail(body["lease"], body["error"])}
+                else:
+                    return self._reply(404, {"error": "not found"})
+            except (ValueError, KeyError, TypeError) as error:
+                return self._reply(400, {"error": str(error)})
+            self._reply(200, reply)
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def run_task(lease, api_options):
+    """ Downloads leased task, returns its result sent to coordinator """
+    from .__main__ import PostDownloader
+    from .api import get_client
+    from .utils import get_page_ids
+
+    job, page_id = lease["job"], lease["page_id"]
+    if page_id is None:
+        page_id = get_page_ids([lease["url"]], get_client(**api_options))[0]
+        if page_id is None:
+            return {"page_id": None}
+
+    downloader = PostDownloader(
+        page_id,
+        _parse_date(job["from"]),
+        _parse_date(job["to"]),
+        job["batch"],
+        api_options,
+        top=job["top"],
+        sort_by=job["sort"],
+        keep_text=False,
+        lean=job["lean"],
+        match=Query(job["match"]) if job["match"] else None,
+    )
+
+    if lease["offset"] is None:
+        start, stop, pinned, _, _ = downloader._plan()
+        if pinned is not None and not downloader._selected(pinned):
+            pinned = None
+        return {
+            "page_id": page_id,
+            "stop": stop,
+            "chunks": list(downloader._split_chunks(start, stop)),
+            "pinned": _post_json(pinned) if pinned is not None else None,
+        }
+
+    posts, boundary, _ = downloader._fetch_chunk(lease["offset"], lease["count"])
+    return {"posts": [_post_json(post) for post in posts], "boundary": boundary}
+
+
+class Worker(object):
+    """ Downloads tasks leased by coordinator at 'url' until all are done """
+
+    def __init__(self, url, api_options=None, name=None):
+        if "://" not in url:
+            url = "http://" + url
+        self.url = url.rstrip("/")
+        self.api_options = api_options or {}
+        self.name = name or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.session = requests.Session()
+
+    def _call(self, method, body):
+        """ Sends request to coordinator, waits for it if it is unreachable """
+        deadline = time.time() + constants.CLUSTER_CONNECT_WAIT
+        while True:
+            try:
+                response = self.session.post(
+                    "{}/{}".format(self.url, method),
+                    json=body,
+                    timeout=self.api_options.get("timeout"),
+                )
+                break
+            except requests.exceptions.ConnectionError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(constants.CLUSTER_POLL_INTERVAL)
+        response.raise_for_status()
+        return response.json()
+
+    def run(self):
+        """ Takes tasks one by one, returns number of downloaded tasks """
+        done = 0
+        while True:
+            reply = self._call("lease", {"worker": self.name})
+            if reply.get("done"):
+                return done
+            if "wait" in reply:
+                time.sleep(reply["wait"])
+                continue
+            if self._work(reply["lease"]):
+                done += 1
+
+    def _heartbeats(self, lease, stopped):
+        """ Sends heartbeats of the lease until 'stopped' Event is set """
+        while not stopped.wait(lease["timeout"] / 3.0):
+            try:
+                if not self._call("heartbeat", {"lease": lease["id"]})["ok"]:
+                    logger.warning("Lease {} is lost".format(lease["id"]))
+                    return
+            except requests.exceptions.RequestException as error:
+                logger.warning("Heartbeat has failed: {}".format(error))
+
+    def _work(self, lease):
+        """ Downloads leased task, returns False if it has failed """
+        logger.debug(
+            "Lease {}: page {} offset {}".format(
+                lease["id"], lease["url"]["text"], lease["offset"]
+            )
+        )
+        stopped = threading.Event()
+        heartbeats = threading.Thread(target=self._heartbeats, args=(lease, stopped))
+        heartbeats.daemon = True
+        heartbeats.start()
+        try:
+            result = run_task(lease, self.api_options)
+        except Exception as error:
+            logger.error("Lease {}: {}".format(lease["id"], error))
+            self._call("fail", {"lease": lease["id"], "error": str(error)})
+            return False
+        finally:
+            stopped.set()
+        self._call("complete", {"lease": lease["id"], "result": result})
+        return True
+
+
+def coordinate(args):
+    """ Runs 'vktop coordinator' with arguments of parse_coordinator_args """
+    from .utils import pretty_print
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    if args.days and (args.from_date or args.to_date):
+        logger.error(
+            "vktop: error: -d/--days option cannot be used with "
+            "-f/--from or -t/--to options"
+        )
+        return 1
+    if args.days:
+        args.from_date = datetime.date.today() - datetime.timedelta(days=args.days)
+
+    if args.match and args.lean:
+        logger.error(
+            "vktop: error: --match cannot be used with --lean option, "
+            "texts of posts are needed"
+        )
+        return 1
+
+    urls = [(url["text"], url) for url in args.urls]
+    try:
+        if args.input:
+            urls.extend(read_urls(args.input))
+    except IOError as error:
+        logger.error(error)
+        return 1
+    if not urls:
+        logger.error("vktop: error: either <url> or -i/--input must be given")
+        return 1
+
+    job = {
+        "from": args.from_date.isoformat() if args.from_date else None,
+        "to": args.to_date.isoformat() if args.to_date else None,
+        "top": args.top,
+        "sort": args.score or args.sort or "likes",
+        "batch": args.batch,
+        "lean": args.lean,
+        "match": args.match.text if args.match else None,
+    }
+    coordinator = Coordinator([url for _, url in urls], job, args.lease_timeout)
+    server = make_server(coordinator, args.host, args.port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info(
+        "Waiting for workers on http://{}:{}".format(*server.server_address[:2])
+    )
+
+    started = time.time()
+    try:
+        # Waiting with timeout lets Ctrl-C through on Python 2
+        while not coordinator.wait(1):
+            pass
+        coordinator.wait_workers(args.lease_timeout)
+    except KeyboardInterrupt:
+        logger.error("Interrupted")
+        return 1
+    finally:
+        server.shutdown()
+        server.server_close()
+    logger.info("Downloaded in {:.1f}s".format(time.time() - started))
+
+    for (text, _), posts, error in zip(urls, coordinator.results, coordinator.errors):
+        if error is not None:
+            continue
+        if len(urls) > 1:
+            print("\n{}".format(text))
+        pretty_print(list(posts))
+    return 1 if len(urls) == 1 and coordinator.errors[0] is not None else 0
+
+
+def work(args):
+    """ Runs 'vktop worker' with arguments of parse_worker_args """
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    try:
+        tokens = load_tokens(args.tokens)
+    except (IOError, ValueError) as error:
+        logger.error(error)
+        return 1
+    set_token_pool(TokenPool(tokens, max_rate=args.rate, strategy=args.token_strategy))
+
+    worker = Worker(args.coordinator, {"timeout": args.timeout})
+    logger.info("Worker {} takes tasks of {}".format(worker.name, worker.url))
+    try:
+        done = worker.run()
+    except requests.exceptions.RequestException as error:
+        logger.error("Coordinator is unavailable: {}".format(error))
+        return 1
+    except KeyboardInterrupt:
+        return 1
+    logger.info("Worker {} has downloaded {} tasks".format(worker.name, done))
+    return 0
@@ -20,14 +20,108 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import re
 
 APP_ACCESS_KEY = (
     "4c078c244c078c244c078c24614c5279bc44c074c078c241564a36b509cacf5c9242daa"
 )
-VKAPI_URL = "https://api.vk.com/method/"
+# May be pointed to other server, e.g. mock API of benchmarks
+VKAPI_URL = os.environ.get("VKTOP_API_URL", "https://api.vk.com/method/")
 VKAPI_VERSION = 5.53
 
+# Maximum number of wall.get items per request
+WALL_PAGE_SIZE = 100
+# Maximum number of API calls packed into a single 'execute' request
+EXECUTE_MAX_CALLS = 25
+# Post fields requested in lean mode, the rest of wall.get item is dropped
+LEAN_FIELDS = (
+    "id",
+    "date",
+    "likes.count",
+    "reposts.count",
+    "is_pinned",
+    "comments.count",
+    "views.count",
+)
+
+# Connections kept alive by a single API client
+API_POOL_SIZE = 10
+# Seconds to wait for connection and for response of API call
+API_TIMEOUT = 30
+
+# Initial and the highest rate of API requests per second
+API_MAX_RPS = 20
+# The lowest rate the limiter backs off to
+API_MIN_RPS = 1
+# Rate growth after every successful request
+API_RPS_INCREASE = 0.05
+# Retries of rate limited or failed API call
+API_MAX_RETRIES = 5
+# Seconds of backoff before the first and the longest retry
+API_BASE_BACKOFF = 0.5
+API_MAX_BACKOFF = 30
+
+# Seconds access token is out of rotation after it was throttled,
+# ran out of daily limit of the method or was revoked
+TOKEN_THROTTLED_COOLDOWN = 1
+TOKEN_EXHAUSTED_COOLDOWN = 60 * 60
+TOKEN_REVOKED_COOLDOWN = 10 * 60
+
+# Requests made by a worker for a single chunk of parallel download
+CHUNK_REQUESTS = 4
+# Times failed chunk is put back to the queue before giving up
+CHUNK_RETRIES = 3
+# Requests made to find posts skipped between pages because wall has
+# changed while it was downloaded, see --consistent
+GAP_MAX_REQUESTS = 10
+
+# Fewer posts are ranked without NumPy, importing it takes longer
+NUMPY_MIN_POSTS = 5000
+
+# Shorter words of posts texts are not indexed, see --match
+SEARCH_MIN_TERM_LENGTH = 2
+
+# Stored posts published within this number of days get fresh counters
+REFRESH_DAYS = 7
+# Growth of counters of trending posts is divided by
+# (age in hours + 2) ** TRENDING_GRAVITY, see PostStore.trending
+TRENDING_GRAVITY = 0.5
+
+# Seconds resolved screen name is kept in cache
+RESOLVER_TTL = 7 * 24 * 60 * 60
+# Number of screen names kept in memory
+RESOLVER_LRU_SIZE = 4096
+
+# Number of wall.get pages in flight for asyncio engine
+ASYNC_CONCURRENCY = 32
+
+# Seconds between redraws of --live table
+LIVE_REDRAW_INTERVAL = 0.2
+
+# Rows of a single row group of columnar export formats
+EXPORT_ROW_GROUP_SIZE = 65536
+
+# Address of 'vktop serve' HTTP server
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8080
+# Seconds between background refreshes of a tracked page
+SERVE_INTERVAL = 600
+# Pages refreshed at the same time, the rest wait in queue
+SERVE_REFRESHES = 2
+# Seconds query of not yet downloaded page waits for its first refresh
+SERVE_WARMUP_WAIT = 60
+
+# Address of 'vktop coordinator' of distributed download
+CLUSTER_HOST = "127.0.0.1"
+CLUSTER_PORT = 8090
+# Seconds a task stays leased to a worker without its heartbeats
+CLUSTER_LEASE_TIMEOUT = 30
+# Seconds idle worker waits before asking coordinator for a task again
+CLUSTER_POLL_INTERVAL = 1
+# Seconds worker keeps trying to reach coordinator before giving up
+CLUSTER_CONNECT_WAIT = 30
+
 TXT_ID_PTRN = r"(?:https?:\/\/)(?:vk.com\/(?!club|public|id|event))" r"(?P<id>(?![_.])(?!club|public|id|event)[a-z0-9_.]*" r"[a-z][a-z0-9_.]*)"
 NUM_ID_PTRN = r"^(?:https?:\/\/)?(?:vk.com\/)?(?P<type>club|public|id|event)" r"(?P<id>\d+)$"
 
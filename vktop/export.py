@@ -0,0 +1,205 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Writers streaming downloaded posts to NDJSON, CSV and Parquet files.
+Posts are written as soon as they are downloaded, in order of arrival,
+so memory usage does not depend on number of exported posts.
+"""
+
+import io
+import os
+import csv
+import sys
+import json
+
+from .constants import EXPORT_ROW_GROUP_SIZE
+
+FIELDS = (
+    "page_id",
+    "id",
+    "url",
+    "date",
+    "likes",
+    "reposts",
+    "comments",
+    "views",
+    "is_pinned",
+    "text",
+)
+
+# File extension -> format
+EXTENSIONS = {
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".json": "ndjson",
+    ".csv": "csv",
+    ".parquet": "parquet",
+}
+
+
+def _row(page_id, post):
+    return (
+        page_id,
+        post.id,
+        post.url,
+        post.date.isoformat(),
+        post.likes,
+        post.reposts,
+        post.comments,
+        post.views,
+        bool(post.is_pinned),
+        post.text,
+    )
+
+
+def _open_text(path):
+    if path == "-":
+        return sys.stdout
+    return io.open(path, "w", encoding="utf-8", newline="")
+
+
+class NDJSONWriter(object):
+    """ Writes posts as JSON objects, one per line """
+
+    def __init__(self, path):
+        self.stream = _open_text(path)
+
+    def write(self, page_id, posts):
+        for post in posts:
+            self.stream.write(
+                json.dumps(dict(zip(FIELDS, _row(page_id, post))), ensure_ascii=False)
+                + "\n"
+            )
+
+    def close(self):
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+
+class CSVWriter(object):
+    """ Writes posts as CSV rows under a header """
+
+    def __init__(self, path):
+        self.stream = _open_text(path)
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(FIELDS)
+
+    def write(self, page_id, posts):
+        self.writer.writerows(_row(page_id, post) for post in posts)
+
+    def close(self):
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+
+class ParquetWriter(object):
+    """
+    Writes posts to Parquet file, 'row_group_size' rows per row group.
+    Only a single row group is kept in memory.
+    """
+
+    def __init__(self, path, row_group_size=EXPORT_ROW_GROUP_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(
+                "parquet export requires pyarrow, install it with: "
+                "pip install vktop[parquet]"
+            )
+
+        self.pyarrow = pyarrow
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema(
+            [
+                ("page_id", pyarrow.int64()),
+                ("id", pyarrow.int64()),
+                ("url", pyarrow.string()),
+                ("date", pyarrow.date32()),
+                ("likes", pyarrow.int64()),
+                ("reposts", pyarrow.int64()),
+                ("comments", pyarrow.int64()),
+                ("views", pyarrow.int64()),
+                ("is_pinned", pyarrow.bool_()),
+                ("text", pyarrow.string()),
+            ]
+        )
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.columns = dict((field, []) for field in FIELDS)
+        self.size = 0
+
+    def write(self, page_id, posts):
+        columns = self.columns
+        for post in posts:
+            columns["page_id"].append(page_id)
+            columns["id"].append(post.id)
+            columns["url"].append(post.url)
+            columns["date"].append(post.date)
+            columns["likes"].append(post.likes)
+            columns["reposts"].append(post.reposts)
+            columns["comments"].append(post.comments)
+            columns["views"].append(post.views)
+            columns["is_pinned"].append(bool(post.is_pinned))
+            columns["text"].append(post.text)
+            self.size += 1
+            if self.size >= self.row_group_size:
+                self._flush()
+
+    def _flush(self):
+        if not self.size:
+            return
+        self.writer.write_table(
+            self.pyarrow.Table.from_pydict(self.columns, schema=self.schema)
+        )
+        for column in self.columns.values():
+            del column[:]
+        self.size = 0
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+WRITERS = {"ndjson": NDJSONWriter, "csv": CSVWriter, "parquet": ParquetWriter}
+
+
+def open_writer(path, fmt=None):
+    """
+    Returns writer of posts to 'path' ('-' is stdout).
+    Format is guessed by file extension unless 'fmt' is given.
+    """
+    if fmt is None:
+        extension = os.path.splitext(path)[1].lower()
+        if path == "-":
+            fmt = "ndjson"
+        elif extension in EXTENSIONS:
+            fmt = EXTENSIONS[extension]
+        else:
+            raise ValueError(
+                "Unknown format of {}, use one of {} extensions or --format".format(
+                    path, ", ".join(sorted(EXTENSIONS))
+                )
+            )
+    if fmt == "parquet" and path == "-":
+        raise ValueError("Parquet can't be written to stdout")
+    return WRITERS[fmt](path)
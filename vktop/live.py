@@ -0,0 +1,135 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Top-N table redrawn in place on terminal while posts are downloaded.
+"""
+
+import sys
+import time
+import datetime
+
+from .constants import LIVE_REDRAW_INTERVAL
+from .ranking import TopN, rank
+from .utils import format_table
+
+# Moves cursor up to the beginning of N-th previous line and clears screen below
+ERASE_LINES = "\033[{}F\033[J"
+BAR_WIDTH = 30
+
+
+def _duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class LiveTable(object):
+    """
+    Keeps posts collected so far for every page, see PostDownloader
+    'progress', and redraws their top-N table with progress bar and
+    estimated time left.
+    """
+
+    def __init__(
+        self, pages, ranking, top, stream=None, interval=LIVE_REDRAW_INTERVAL
+    ):
+        # (url text, page_id) pairs
+        self.pages = pages
+        self.ranking = ranking
+        self.top = top
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.started = time.time()
+        self._posts = [[] for _ in pages]
+        self._progress = [(0, 0) for _ in pages]
+        self._drawn_lines = 0
+        self._drawn_at = 0
+
+    def progress(self, slot):
+        """ Returns 'progress' callback of PostDownloader of 'slot' page """
+
+        def update(posts, done, total):
+            self._posts[slot] = posts
+            self._progress[slot] = (done, total)
+            self.draw()
+
+        return update
+
+    def _top(self, posts):
+        # TopN is ranked already
+        if isinstance(posts, TopN):
+            return list(posts)[: self.top]
+        return rank(posts, self.ranking, self.top)
+
+    def results(self):
+        """ Returns the most popular posts of every page downloaded so far """
+        return [self._top(posts) for posts in self._posts]
+
+    def _progress_bar(self):
+        done = sum(done for done, _ in self._progress)
+        total = sum(total for _, total in self._progress)
+        fraction = float(done) / total if total else 0.0
+        filled = int(BAR_WIDTH * fraction)
+        elapsed = time.time() - self.started
+        eta = _duration(elapsed * (total - done) / done) if done else "?"
+        return "[{}{}] {:3.0f}% {}/{} posts, elapsed {}, left {}".format(
+            "#" * filled,
+            "." * (BAR_WIDTH - filled),
+            100 * fraction,
+            done,
+            total,
+            _duration(elapsed),
+            eta,
+        )
+
+    def render(self, status=None):
+        """ Returns text of the table, progress bar and 'status' line """
+        lines = []
+        for (text, _), posts in zip(self.pages, self.results()):
+            if len(self.pages) > 1:
+                lines.append("\n{}".format(text))
+            lines.append(format_table(posts) if posts else "\nNo posts yet")
+        lines.append("")
+        lines.append(self._progress_bar())
+        if status:
+            lines.append(status)
+        return "\n".join(lines)
+
+    def draw(self, status=None, force=False):
+        """ Redraws the table, at most once per 'interval' unless 'force' """
+        now = time.time()
+        if not force and now - self._drawn_at < self.interval:
+            return
+        self._drawn_at = now
+
+        text = self.render(status)
+        if self._drawn_lines:
+            self.stream.write(ERASE_LINES.format(self._drawn_lines))
+        self.stream.write(text + "\n")
+        self.stream.flush()
+        self._drawn_lines = text.count("\n") + 1
+
+    def close(self, interrupted=False):
+        """ Draws the final table """
+        status = None
+        if interrupted:
+            status = "Interrupted, showing posts downloaded so far"
+        self.draw(status, force=True)
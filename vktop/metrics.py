@@ -0,0 +1,203 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import json
+import time
+from collections import defaultdict
+
+# Upper bounds of API call latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class Metrics:
+    """
+    Counters of API calls, latency histogram and timeline of requests
+    of every worker. Workers send their metrics to the parent process,
+    where they are merged.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        # (name, label) -> value
+        self.counters = defaultdict(int)
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        # worker -> list of (start, end) of requests
+        self.timelines = defaultdict(list)
+
+    def count(self, name, label="", value=1):
+        self.counters[(name, label)] += value
+
+    def observe_request(self, method, started, size=0, error=None):
+        """ Records single API request which took since 'started' time """
+        finished = time.time()
+        latency = finished - started
+
+        self.count("requests", method)
+        self.count("bytes", method, size)
+        if error is not None:
+            self.count("errors", getattr(error, "code", None) or type(error).__name__)
+
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.latency_buckets[i] += 1
+                break
+        self.latency_sum += latency
+        from multiprocessing import current_process
+
+        self.timelines[current_process().name].append((started, finished))
+
+    def merge(self, other):
+        for key, value in other.counters.items():
+            self.counters[key] += value
+        for i, value in enumerate(other.latency_buckets):
+            self.latency_buckets[i] += value
+        self.latency_sum += other.latency_sum
+        for worker, timeline in other.timelines.items():
+            self.timelines[worker].extend(timeline)
+
+    def drain(self):
+        """ Returns collected metrics and starts collecting from scratch """
+        drained = Metrics()
+        drained.__dict__, self.__dict__ = self.__dict__, drained.__dict__
+        return drained
+
+    def total(self, name):
+        return sum(value for (key, _), value in self.counters.items() if key == name)
+
+    def workers(self):
+        """ Returns worker -> (requests, busy seconds, idle seconds) """
+        finished = time.time()
+        workers = {}
+        for worker, timeline in self.timelines.items():
+            # Requests of async worker overlap, busy time is their union
+            busy, busy_until = 0.0, 0.0
+            for start, end in sorted(timeline):
+                if end > busy_until:
+                    busy += end - max(start, busy_until)
+                    busy_until = end
+            workers[worker] = (len(timeline), busy, finished - self.started - busy)
+        return workers
+
+    def as_dict(self):
+        counters = defaultdict(dict)
+        for (name, label), value in self.counters.items():
+            counters[name][str(label) or "total"] = value
+        return {
+            "elapsed": time.time() - self.started,
+            "counters": counters,
+            "latency": {
+                "buckets": dict(
+                    (str(bound), count)
+                    for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)
+                ),
+                "sum": self.latency_sum,
+                "count": sum(self.latency_buckets),
+            },
+            "workers": dict(
+                (worker, {"requests": requests, "busy": busy, "idle": idle})
+                for worker, (requests, busy, idle) in self.workers().items()
+            ),
+        }
+
+    def format(self, fmt="text"):
+        """ Returns metrics as 'text', 'json' or 'prometheus' exposition format """
+        if fmt == "json":
+            return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        if fmt == "prometheus":
+            return self._prometheus()
+        return self._text()
+
+    def _text(self):
+        requests = sum(self.latency_buckets)
+        lines = [
+            "Elapsed:   {:.2f}s".format(time.time() - self.started),
+            "Requests:  {}".format(self.total("requests")),
+            "Posts:     {}".format(self.total("posts")),
+            "Bytes:     {}".format(self.total("bytes")),
+            "Errors:    {}".format(self.total("errors")),
+            "Retries:   {}".format(self.total("retries")),
+            "Throttled: {}".format(self.total("throttled")),
+            "Suspended: {}".format(self.total("suspended")),
+            "Gaps:      {}".format(self.total("gaps")),
+            "Latency:   avg {:.3f}s".format(
+                self.latency_sum / requests if requests else 0
+            ),
+        ]
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            cumulative += count
+            lines.append("  <= {:<6} {:>8}".format(bound, cumulative))
+
+        lines.append("Workers:")
+        for worker, (requests, busy, idle) in sorted(self.workers().items()):
+            lines.append(
+                "  {:<24} {:>6} requests, busy {:.2f}s, idle {:.2f}s".format(
+                    worker, requests, busy, idle
+                )
+            )
+        return "\n".join(lines)
+
+    def _prometheus(self):
+        lines = []
+        names = sorted(set(name for name, _ in self.counters))
+        for name in names:
+            metric = "vktop_{}_total".format(name)
+            lines.append("# TYPE {} counter".format(metric))
+            for (key, label), value in sorted(
+                self.counters.items(), key=lambda item: str(item[0])
+            ):
+                if key != name:
+                    continue
+                label_name = "code" if name == "errors" else "method"
+                if label:
+                    lines.append(
+                        '{}{{{}="{}"}} {}'.format(metric, label_name, label, value)
+                    )
+                else:
+                    lines.append("{} {}".format(metric, value))
+
+        metric = "vktop_request_duration_seconds"
+        lines.append("# TYPE {} histogram".format(metric))
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            cumulative += count
+            bound = "+Inf" if bound == float("inf") else bound
+            lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+        lines.append("{}_sum {}".format(metric, self.latency_sum))
+        lines.append("{}_count {}".format(metric, cumulative))
+
+        for name, index in (("busy", 1), ("idle", 2)):
+            metric = "vktop_worker_{}_seconds".format(name)
+            lines.append("# TYPE {} gauge".format(metric))
+            for worker, values in sorted(self.workers().items()):
+                lines.append('{}{{worker="{}"}} {}'.format(metric, worker, values[index]))
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """ Returns metrics of current process """
+    return _metrics
@@ -21,8 +21,39 @@
 # SOFTWARE.
 
 
-class Post:
-    def __init__(self, id, likes, reposts, date, text, url=None, is_pinned=0):
+import datetime
+from array import array
+
+POST_URL = "https://vk.com/wall{}_{}"
+
+
+class Post(object):
+    __slots__ = (
+        "_id",
+        "_likes",
+        "_reposts",
+        "_text",
+        "_date",
+        "_url",
+        "_is_pinned",
+        "_page_id",
+        "_comments",
+        "_views",
+    )
+
+    def __init__(
+        self,
+        id,
+        likes,
+        reposts,
+        date,
+        text=None,
+        url=None,
+        is_pinned=0,
+        page_id=None,
+        comments=0,
+        views=0,
+    ):
         self._id = id
         self._likes = likes
         self._reposts = reposts
@@ -30,6 +61,11 @@ class Post:
         self._date = date
         self._url = url
         self._is_pinned = is_pinned
+        # Used to build url on demand when it is not given
+        self._page_id = page_id
+        self._comments = comments
+        # Posts published before views were counted have no views
+        self._views = views
 
     @property
     def id(self):
@@ -53,8 +89,138 @@ class Post:
 
     @property
     def url(self):
+        if self._url is None and self._page_id is not None:
+            return POST_URL.format(self._page_id, self._id)
         return self._url
 
     @property
     def is_pinned(self):
         return self._is_pinned
+
+    @property
+    def comments(self):
+        return self._comments
+
+    @property
+    def views(self):
+        return self._views
+
+
+class PostBatch(object):
+    """
+    Compact list of posts of a single page.
+    Numeric fields are kept in typed arrays, Post objects are created
+    only when items are accessed.
+    """
+
+    def __init__(self, page_id, keep_text=True):
+        self.page_id = page_id
+        self.ids = array("i")
+        self.likes = array("i")
+        self.reposts = array("i")
+        self.comments = array("i")
+        self.views = array("i")
+        # Ordinals of datetime.date
+        self.dates = array("i")
+        self.pinned = array("b")
+        self.texts = [] if keep_text else None
+
+    @classmethod
+    def from_columns(
+        cls, page_id, ids, likes, reposts, timestamps, pinned, comments, views
+    ):
+        """
+        Builds batch of posts given as columns of raw wall.get fields,
+        see api.projection_code. Texts are not kept.
+        """
+        batch = cls(page_id, keep_text=False)
+        batch.ids = array("i", ids)
+        batch.likes = array("i", likes)
+        batch.reposts = array("i", reposts)
+        batch.comments = array("i", [count or 0 for count in comments])
+        batch.views = array("i", [count or 0 for count in views])
+        fromtimestamp = datetime.date.fromtimestamp
+        batch.dates = array("i", [fromtimestamp(ts).toordinal() for ts in timestamps])
+        # Field is missing for posts which are not pinned
+        batch.pinned = array("b", [is_pinned or 0 for is_pinned in pinned])
+        return batch
+
+    def append(self, post):
+        self.ids.append(post.id)
+        self.likes.append(post.likes)
+        self.reposts.append(post.reposts)
+        self.comments.append(post.comments)
+        self.views.append(post.views)
+        self.dates.append(post.date.toordinal())
+        self.pinned.append(post.is_pinned)
+        if self.texts is not None:
+            self.texts.append(post.text)
+
+    def extend(self, posts):
+        if isinstance(posts, PostBatch) and (self.texts is None) == (
+            posts.texts is None
+        ):
+            self.ids.extend(posts.ids)
+            self.likes.extend(posts.likes)
+            self.reposts.extend(posts.reposts)
+            self.comments.extend(posts.comments)
+            self.views.extend(posts.views)
+            self.dates.extend(posts.dates)
+            self.pinned.extend(posts.pinned)
+            if self.texts is not None:
+                self.texts.extend(posts.texts)
+        else:
+            for post in posts:
+                self.append(post)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        return Post(
+            id=self.ids[index],
+            likes=self.likes[index],
+            reposts=self.reposts[index],
+            date=datetime.date.fromordinal(self.dates[index]),
+            text=self.texts[index] if self.texts is not None else None,
+            is_pinned=self.pinned[index],
+            page_id=self.page_id,
+            comments=self.comments[index],
+            views=self.views[index],
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class IdSet(object):
+    """
+    Set of post ids kept as a bitmap, one bit per id.
+    Ids of a wall are dense, so a wall of a million posts takes ~125KB.
+    """
+
+    def __init__(self, max_id=0):
+        self._bits = bytearray((max_id >> 3) + 1)
+        self._size = 0
+
+    def add(self, post_id):
+        """ Adds id, returns False if it was added before """
+        byte, bit = post_id >> 3, 1 << (post_id & 7)
+        if byte >= len(self._bits):
+            self._bits.extend(bytearray(byte + 1 - len(self._bits)))
+        if self._bits[byte] & bit:
+            return False
+        self._bits[byte] |= bit
+        self._size += 1
+        return True
+
+    def __contains__(self, post_id):
+        byte = post_id >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & 1 << (post_id & 7))
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,378 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Ranking of posts by counters and score expressions.
+Scores are computed over NumPy arrays when NumPy is installed and there
+are many posts, otherwise post by post.
+"""
+
+# Scores are floats on Python 2 as well, same as NumPy ones
+from __future__ import division
+
+import ast
+import sys
+import math
+import heapq
+import datetime
+import itertools
+
+from .constants import NUMPY_MIN_POSTS
+
+# NumPy module, None if it is not installed, imported on first ranking
+numpy = False
+
+
+def _import_numpy():
+    global numpy
+    if numpy is False:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+def by_likes(post):
+    return -post.likes, -post.reposts
+
+
+def by_reposts(post):
+    return -post.reposts, -post.likes
+
+
+# Sort keys of posts, the most popular posts go first
+SORT_KEYS = {"likes": by_likes, "reposts": by_reposts}
+
+
+class TopN:
+    """
+    Keeps 'size' posts with the smallest 'key' seen so far.
+    Memory usage is O(size) regardless of number of added posts.
+    Posts with equal keys keep order of adding, same as in sorted().
+    """
+
+    def __init__(self, size, key=by_likes):
+        self.size = size
+        self.key = key
+        self._counter = itertools.count()
+        # Heap root is the least popular post of kept ones
+        self._heap = []
+
+    def append(self, post):
+        entry = (
+            tuple(-value for value in self.key(post)),
+            -next(self._counter),
+            post,
+        )
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def extend(self, posts):
+        for post in posts:
+            self.append(post)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        """ Iterates over kept posts from the most popular one """
+        return (entry[2] for entry in sorted(self._heap, reverse=True))
+
+    def __getstate__(self):
+        # itertools.count can't be pickled
+        state = dict(self.__dict__)
+        state["_counter"] = next(self._counter)
+        return state
+
+    def __setstate__(self, state):
+        state["_counter"] = itertools.count(state["_counter"])
+        self.__dict__.update(state)
+
+
+# Names available in score expressions, 'age' is number of days since
+# publication, posts published today are 1 day old
+VARIABLES = ("likes", "reposts", "comments", "views", "age")
+
+
+def _divide(a, b):
+    # Division by zero gives zero, e.g. engagement of post without views
+    return a / b if b else 0.0
+
+
+def _numpy_divide(a, b):
+    a, b = numpy.broadcast_arrays(numpy.asarray(a, float), numpy.asarray(b, float))
+    return numpy.divide(a, b, out=numpy.zeros(a.shape), where=b != 0)
+
+
+PYTHON_FUNCTIONS = {
+    "divide": _divide,
+    "sqrt": lambda x: math.sqrt(max(x, 0)),
+    "log1p": lambda x: math.log1p(max(x, 0)),
+    "abs": abs,
+    "min": min,
+    "max": max,
+}
+
+NUMPY_FUNCTIONS = {
+    "divide": _numpy_divide,
+    "sqrt": lambda x: numpy.sqrt(numpy.maximum(x, 0)),
+    "log1p": lambda x: numpy.log1p(numpy.maximum(x, 0)),
+    "abs": lambda x: numpy.abs(x),
+    "min": lambda *args: numpy.minimum.reduce(numpy.broadcast_arrays(*args)),
+    "max": lambda *args: numpy.maximum.reduce(numpy.broadcast_arrays(*args)),
+}
+
+# Functions available in score expressions and their numbers of arguments
+FUNCTIONS = {
+    "sqrt": (1, 1),
+    "log1p": (1, 1),
+    "abs": (1, 1),
+    "min": (2, None),
+    "max": (2, None),
+}
+
+if sys.version_info >= (3, 8):
+    _NUMBER = ast.Constant
+else:
+    _NUMBER = ast.Num
+
+_OPERATORS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+}
+
+
+class Score(object):
+    """
+    Arithmetic expression over post counters, e.g. '(likes + reposts) / views'.
+    Only numbers, VARIABLES, FUNCTIONS and + - * / are allowed,
+    the expression is never passed to eval().
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        try:
+            self._tree = ast.parse(expression.strip(), mode="eval").body
+        except SyntaxError:
+            raise ValueError("{} - invalid score expression".format(expression))
+        nodes = list(ast.walk(self._tree))
+        callees = set(id(node.func) for node in nodes if isinstance(node, ast.Call))
+        for node in nodes:
+            self._check(node, callees)
+
+    def _check(self, node, callees):
+        if isinstance(node, _NUMBER):
+            value = node.value if sys.version_info >= (3, 8) else node.n
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return
+        elif isinstance(node, ast.Name):
+            if node.id in (FUNCTIONS if id(node) in callees else VARIABLES):
+                return
+            raise ValueError("{} - unknown name in score expression".format(node.id))
+        elif isinstance(node, ast.Call):
+            if (
+                isinstance(node.func, ast.Name)
+                and node.func.id in FUNCTIONS
+                and not node.keywords
+            ):
+                min_args, max_args = FUNCTIONS[node.func.id]
+                if min_args <= len(node.args) <= (max_args or len(node.args)):
+                    return
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) in _OPERATORS or isinstance(node.op, ast.Div):
+                return
+        elif isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, (ast.UAdd, ast.USub)):
+                return
+        elif isinstance(
+            node, (ast.Load, ast.operator, ast.unaryop, ast.expr_context)
+        ):
+            return
+        raise ValueError(
+            "{} - unsupported score expression".format(self.expression)
+        )
+
+    def evaluate(self, variables, functions=PYTHON_FUNCTIONS):
+        """ Computes score given values (or arrays of values) of VARIABLES """
+        return self._evaluate(self._tree, variables, functions)
+
+    def _evaluate(self, node, variables, functions):
+        if isinstance(node, _NUMBER):
+            return node.value if sys.version_info >= (3, 8) else node.n
+        if isinstance(node, ast.Name):
+            return variables[node.id]
+        if isinstance(node, ast.Call):
+            args = [self._evaluate(arg, variables, functions) for arg in node.args]
+            return functions[node.func.id](*args)
+        if isinstance(node, ast.UnaryOp):
+            value = self._evaluate(node.operand, variables, functions)
+            return -value if isinstance(node.op, ast.USub) else value
+
+        left = self._evaluate(node.left, variables, functions)
+        right = self._evaluate(node.right, variables, functions)
+        if isinstance(node.op, ast.Div):
+            return functions["divide"](left, right)
+        return _OPERATORS[type(node.op)](left, right)
+
+    def __getstate__(self):
+        # AST is rebuilt in worker processes
+        return self.expression
+
+    def __setstate__(self, expression):
+        self.__init__(expression)
+
+
+class Ranking(object):
+    """
+    Order of posts by one or several score expressions, each next one
+    breaks ties of the previous ones. The most popular posts go first,
+    equal posts keep their order.
+    'key' is an equivalent sort key of a single post, if it is known.
+    """
+
+    def __init__(self, *expressions, **options):
+        self.scores = [Score(expression) for expression in expressions]
+        self._key = options.get("key")
+        # Age is counted from the same day in every worker
+        self.today = datetime.date.today().toordinal()
+
+    def key(self, post):
+        """ Sort key of a single post, see TopN """
+        if self._key is not None:
+            return self._key(post)
+        variables = {
+            "likes": post.likes,
+            "reposts": post.reposts,
+            "comments": post.comments,
+            "views": post.views,
+            "age": max(self.today - post.date.toordinal() + 1, 1),
+        }
+        return tuple(-score.evaluate(variables) for score in self.scores)
+
+    def _columns(self, posts):
+        """ Returns VARIABLES of all posts as NumPy arrays """
+        if hasattr(posts, "dates"):
+            # PostBatch keeps counters in arrays already
+            columns = {
+                "likes": posts.likes,
+                "reposts": posts.reposts,
+                "comments": posts.comments,
+                "views": posts.views,
+                "age": posts.dates,
+            }
+            columns = dict(
+                (name, numpy.asarray(column, dtype=float))
+                for name, column in columns.items()
+            )
+        else:
+            columns = dict(
+                (name, numpy.fromiter(values, dtype=float, count=len(posts)))
+                for name, values in (
+                    ("likes", (post.likes for post in posts)),
+                    ("reposts", (post.reposts for post in posts)),
+                    ("comments", (post.comments for post in posts)),
+                    ("views", (post.views for post in posts)),
+                    ("age", (post.date.toordinal() for post in posts)),
+                )
+            )
+        columns["age"] = numpy.maximum(self.today - columns["age"] + 1, 1)
+        return columns
+
+    def indices(self, posts, top=None):
+        """ Returns indices of 'top' most popular posts (all if 'top' is None) """
+        num_posts = len(posts)
+        if top is not None and top >= num_posts:
+            top = None
+
+        if num_posts < NUMPY_MIN_POSTS or _import_numpy() is None:
+            if top is None:
+                return sorted(range(num_posts), key=lambda i: self.key(posts[i]))
+            return heapq.nsmallest(
+                top, range(num_posts), key=lambda i: self.key(posts[i])
+            )
+
+        columns = self._columns(posts)
+        keys = [
+            numpy.broadcast_to(
+                numpy.asarray(score.evaluate(columns, NUMPY_FUNCTIONS), float),
+                (num_posts,),
+            )
+            for score in self.scores
+        ]
+
+        candidates = numpy.arange(num_posts)
+        if top is not None:
+            # Partial selection of 'top' scores, posts tied with the last
+            # of them are kept as candidates, so result matches full sort
+            selected = numpy.argpartition(-keys[0], top - 1)[:top]
+            candidates = numpy.nonzero(keys[0] >= keys[0][selected].min())[0]
+
+        # lexsort is stable and sorts by the last key first
+        order = numpy.lexsort([-key[candidates] for key in reversed(keys)])
+        return candidates[order][:top].tolist()
+
+    def top(self, posts, top=None):
+        """ Returns list of 'top' most popular posts (all if 'top' is None) """
+        if top is not None and (
+            len(posts) < NUMPY_MIN_POSTS or _import_numpy() is None
+        ):
+            collector = TopN(top, self.key)
+            collector.extend(posts)
+            return list(collector)
+        return [posts[i] for i in self.indices(posts, top)]
+
+
+# Named rankings selectable by --sort: score expressions and sort key
+RANKINGS = {
+    "likes": (("likes", "reposts"), by_likes),
+    "reposts": (("reposts", "likes"), by_reposts),
+    "comments": (("comments", "likes"), None),
+    "views": (("views", "likes"), None),
+    # Reactions per view
+    "engagement": (("(likes + reposts + comments) / views", "likes"), None),
+    # Age-normalized counters, favour recent posts
+    "likes_per_day": (("likes / age", "likes"), None),
+    "reposts_per_day": (("reposts / age", "reposts"), None),
+}
+
+
+def get_ranking(sort_by):
+    """
+    Returns Ranking given its name in RANKINGS, score expression
+    or Ranking itself.
+    """
+    if isinstance(sort_by, Ranking):
+        return sort_by
+    if sort_by in RANKINGS:
+        expressions, key = RANKINGS[sort_by]
+        return Ranking(*expressions, key=key)
+    return Ranking(sort_by)
+
+
+def rank(posts, sort_by="likes", top=None):
+    """ Returns list of 'top' most popular posts (all if 'top' is None) """
+    return get_ranking(sort_by).top(posts, top)
@@ -0,0 +1,90 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import time
+import random
+
+from . import constants
+
+
+class RateLimiter:
+    """
+    Token bucket limiting API requests per second.
+    State lives in shared memory, so a single limiter can be handed
+    to worker processes and throttles all of them together.
+
+    Rate adapts to API responses: it is halved every time the API
+    complains about too many requests and slowly grows back to
+    'max_rate' on successful calls.
+    """
+
+    def __init__(self, max_rate=constants.API_MAX_RPS, min_rate=constants.API_MIN_RPS):
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        # Imported here to keep startup of vktop fast
+        import multiprocessing
+
+        # rate, available tokens, time of last update
+        self._state = multiprocessing.Array("d", [self.max_rate, 1.0, time.time()])
+
+    @property
+    def rate(self):
+        return self._state[0]
+
+    def reserve(self):
+        """
+        Takes one token from the bucket.
+        Returns number of seconds caller must wait before sending request.
+        """
+        with self._state.get_lock():
+            rate, tokens, last_update = self._state[:]
+            now = time.time()
+            tokens = min(max(rate, 1.0), tokens + (now - last_update) * rate) - 1
+            self._state[1], self._state[2] = tokens, now
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+    def wait(self):
+        """ Blocks until request is allowed """
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def throttled(self):
+        """ Multiplicative decrease after 'too many requests' response """
+        with self._state.get_lock():
+            self._state[0] = max(self.min_rate, self._state[0] / 2)
+            self._state[1] = min(self._state[1], 0.0)
+
+    def succeeded(self):
+        """ Additive increase after successful request """
+        with self._state.get_lock():
+            self._state[0] = min(
+                self.max_rate, self._state[0] + constants.API_RPS_INCREASE
+            )
+
+
+def backoff_delay(attempt):
+    """ Exponential backoff with jitter for 'attempt' retry (starting from 0) """
+    delay = min(constants.API_MAX_BACKOFF, constants.API_BASE_BACKOFF * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
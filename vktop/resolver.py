@@ -0,0 +1,115 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import time
+import errno
+import sqlite3
+import logging
+from collections import OrderedDict
+
+from . import constants
+
+logger = logging.getLogger()
+
+
+def default_cache_path():
+    """ Returns path of screen names cache in user's cache directory """
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_dir, "vktop", "screen_names.sqlite")
+
+
+class ScreenNameCache:
+    """
+    Cache of screen name -> numeric page ID.
+    Resolved names are kept in SQLite database on disk for 'ttl' seconds,
+    recently used ones are also kept in memory.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        ttl=constants.RESOLVER_TTL,
+        size=constants.RESOLVER_LRU_SIZE,
+    ):
+        self.ttl = ttl
+        self.size = size
+        self._lru = OrderedDict()
+
+        path = path or default_cache_path()
+        directory = os.path.dirname(path)
+        if path != ":memory:" and directory:
+            try:
+                os.makedirs(directory)
+            except OSError as error:
+                # Other vktop process may have created it meanwhile
+                if error.errno != errno.EEXIST:
+                    raise
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS screen_names ("
+            "name TEXT PRIMARY KEY, page_id INTEGER NOT NULL, "
+            "resolved_at REAL NOT NULL)"
+        )
+
+    def get(self, name):
+        """ Returns cached page ID or None """
+        now = time.time()
+        if name in self._lru:
+            page_id, resolved_at = self._lru[name]
+            if now - resolved_at < self.ttl:
+                self._lru[name] = self._lru.pop(name)
+                return page_id
+            del self._lru[name]
+
+        row = self.connection.execute(
+            "SELECT page_id, resolved_at FROM screen_names WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None or now - row[1] >= self.ttl:
+            return None
+
+        self._remember(name, row[0], row[1])
+        return row[0]
+
+    def put_many(self, resolved):
+        """ Caches dict of screen name -> page ID """
+        now = time.time()
+        for name, page_id in resolved.items():
+            self._remember(name, page_id, now)
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO screen_names VALUES (?, ?, ?)",
+                ((name, page_id, now) for name, page_id in resolved.items()),
+            )
+
+    def _remember(self, name, page_id, resolved_at):
+        self._lru.pop(name, None)
+        self._lru[name] = (page_id, resolved_at)
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,95 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Keyword search in texts of posts, see --match.
+Texts are split into terms: words case-folded with 'ё' replaced by 'е',
+so 'Ёлка', 'ёлка' and 'елка' are the same term. Query is a list of terms
+all of which must be found in text, term ending with '*' matches every
+term starting with it, e.g. 'москв*' matches 'москва' and 'москве'.
+"""
+
+import re
+
+from .constants import SEARCH_MIN_TERM_LENGTH
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+WORD_REGEXP = re.compile(r"[^\W_]+", re.UNICODE)
+PREFIX = "*"
+
+
+def _fold(text):
+    if isinstance(text, bytes):
+        text = text.decode("utf-8")
+    text = text.casefold() if hasattr(text, "casefold") else text.lower()
+    return text.replace(u"ё", u"е")
+
+
+def tokenize(text):
+    """ Returns terms of text in order of appearance, with repeats """
+    if not text:
+        return []
+    return [
+        word
+        for word in WORD_REGEXP.findall(_fold(text))
+        if len(word) >= SEARCH_MIN_TERM_LENGTH
+    ]
+
+
+class Query(object):
+    """ Parsed --match query """
+
+    def __init__(self, text):
+        self.text = text
+        # Whole terms and prefixes of terms
+        self.terms, self.prefixes = [], []
+        for word in _fold(text).split():
+            terms = tokenize(word)
+            # Only the last term of 'северо-запад*' is a prefix
+            if word.endswith(PREFIX) and terms:
+                self.prefixes.append(terms.pop())
+            self.terms.extend(terms)
+        if not self.terms and not self.prefixes:
+            raise ValueError(
+                "{} - no words of {} or more letters to match".format(
+                    text, SEARCH_MIN_TERM_LENGTH
+                )
+            )
+
+    def matches(self, text):
+        """ Checks that all terms of query are found in text """
+        terms = set(tokenize(text))
+        return all(term in terms for term in self.terms) and all(
+            any(term.startswith(prefix) for term in terms) for prefix in self.prefixes
+        )
+
+    def __str__(self):
+        return self.text
+
+
+def prefix_range(prefix):
+    """ Returns [lo, hi) range of all strings starting with prefix """
+    return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
@@ -0,0 +1,373 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+'vktop serve': HTTP server answering top-N queries from posts kept in memory.
+"""
+
+import json
+import time
+import sqlite3
+import logging
+import datetime
+import threading
+from array import array
+from argparse import ArgumentTypeError
+
+import requests
+
+try:
+    from queue import Queue
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from Queue import Queue
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+from . import constants
+from .api import VKApiError, get_client
+from .argparser import url_validator, pos_int_validator, date_validator
+from .tokens import TokenPool, load_tokens, set_token_pool
+from .ranking import RANKINGS, get_ranking
+from .resolver import ScreenNameCache
+from .utils import get_page_ids, read_urls
+
+logger = logging.getLogger()
+
+
+class Snapshot(object):
+    """ Posts of a page downloaded by a single refresh """
+
+    def __init__(self, posts, updated):
+        self.posts = posts
+        self.updated = updated
+        # Indexes of posts ordered by sort key, computed on its first query,
+        # so further queries only walk them until 'n' posts of their date
+        # range are found. Posts are created only for returned indexes.
+        self._orders = {}
+        self._lock = threading.Lock()
+
+    def order(self, sort_by):
+        """ Returns indexes of all posts ranked by 'sort_by' """
+        with self._lock:
+            if sort_by not in self._orders:
+                self._orders[sort_by] = array(
+                    "q", get_ranking(sort_by).indices(self.posts)
+                )
+            return self._orders[sort_by]
+
+    def top(self, n, sort_by="likes", from_date=None, to_date=None):
+        """ Returns 'n' most popular posts published between given dates """
+        lo = (from_date or datetime.date.min).toordinal()
+        hi = (to_date or datetime.date.max).toordinal()
+        dates = self.posts.dates
+        top_posts = []
+        for index in self.order(sort_by):
+            if lo <= dates[index] <= hi:
+                top_posts.append(self.posts[index])
+                if len(top_posts) == n:
+                    break
+        return top_posts
+
+
+class PageCache(object):
+    """
+    Posts of tracked pages kept in memory and refreshed in background.
+    Refreshes are made by a fixed number of threads, so number of
+    downloads in flight does not grow with number of pages or queries,
+    and all of them share the process-wide token pool.
+    """
+
+    def __init__(
+        self,
+        interval=constants.SERVE_INTERVAL,
+        refreshes=constants.SERVE_REFRESHES,
+        days=None,
+        downloader_options=None,
+        names_cache=None,
+    ):
+        self.interval = interval
+        self.days = days
+        # Keyword arguments of PostDownloader
+        self.downloader_options = downloader_options or {}
+        self.names_cache = names_cache
+
+        self._lock = threading.Lock()
+        self._resolve_lock = threading.Lock()
+        self._snapshots = {}
+        # page_id -> Event set when the page is downloaded for the first time
+        self._ready = {}
+        # page_id -> time of the last refresh start
+        self._refreshed = {}
+        self._queued = set()
+        self._queue = Queue()
+        self._page_ids = {}
+
+        for _ in range(refreshes):
+            self._start(self._refresh_worker)
+        self._start(self._scheduler)
+
+    @staticmethod
+    def _start(target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    def resolve(self, url):
+        """ Returns numeric ID of page given by parsed url """
+        with self._resolve_lock:
+            if url["text"] not in self._page_ids:
+                api = get_client(**self.downloader_options.get("api_options", {}))
+                page_id = get_page_ids([url], api, self.names_cache)[0]
+                if page_id is None:
+                    raise RuntimeError(
+                        "Troubles with resolving {} id".format(url["id"])
+                    )
+                self._page_ids[url["text"]] = page_id
+            return self._page_ids[url["text"]]
+
+    def track(self, page_id):
+        """ Starts refreshing of the page, returns its readiness Event """
+        with self._lock:
+            if page_id in self._ready:
+                return self._ready[page_id]
+            self._ready[page_id] = threading.Event()
+        self._schedule(page_id)
+        return self._ready[page_id]
+
+    def snapshot(self, page_id, wait=constants.SERVE_WARMUP_WAIT):
+        """
+        Returns the latest Snapshot of the page, tracking it if needed.
+        Waits up to 'wait' seconds for the first download, then returns None.
+        """
+        if not self.track(page_id).wait(wait):
+            return None
+        return self._snapshots[page_id]
+
+    def _schedule(self, page_id):
+        with self._lock:
+            if page_id in self._queued:
+                return
+            self._queued.add(page_id)
+            self._refreshed[page_id] = time.time()
+        self._queue.put(page_id)
+
+    def _scheduler(self):
+        """ Puts pages to refresh queue every 'interval' seconds """
+        while True:
+            time.sleep(min(self.interval, 1))
+            now = time.time()
+            with self._lock:
+                due = [
+                    page_id
+                    for page_id, started in self._refreshed.items()
+                    if now - started >= self.interval
+                ]
+            for page_id in due:
+                self._schedule(page_id)
+
+    def _refresh_worker(self):
+        while True:
+            page_id = self._queue.get()
+            # Unexpected error must not stop the thread, the page is
+            # refreshed again in 'interval' seconds
+            try:
+                self._refresh(page_id)
+            except Exception as error:
+                logger.error("Page {}: refresh has failed: {!r}".format(page_id, error))
+                with self._lock:
+                    self._queued.discard(page_id)
+
+    def _refresh(self, page_id):
+        """ Downloads posts of the page and replaces its snapshot """
+        from .__main__ import PostDownloader
+
+        from_date = None
+        if self.days:
+            from_date = datetime.date.today() - datetime.timedelta(days=self.days)
+        downloader = PostDownloader(page_id, from_date, **self.downloader_options)
+
+        started = time.time()
+        try:
+            posts = downloader.fetch()
+        except (VKApiError, requests.exceptions.RequestException) as error:
+            logger.error("Page {}: {}".format(page_id, error))
+            return
+        finally:
+            with self._lock:
+                self._queued.discard(page_id)
+
+        self._snapshots[page_id] = Snapshot(posts, time.time())
+        self._ready[page_id].set()
+        logger.info(
+            "Page {}: {} posts refreshed in {:.1f}s".format(
+                page_id, len(posts), time.time() - started
+            )
+        )
+
+
+def parse_query(query):
+    """ Returns arguments of /top request given its parsed query string """
+
+    def param(name, default=None):
+        return query[name][0] if name in query else default
+
+    if "page" not in query:
+        raise ArgumentTypeError("page parameter is required")
+    sort_by = param("sort", "likes")
+    if sort_by not in RANKINGS:
+        raise ArgumentTypeError("{} - unknown sort order".format(sort_by))
+    return {
+        "url": url_validator(param("page")),
+        "n": pos_int_validator(param("n", "10")),
+        "sort_by": sort_by,
+        "from_date": date_validator(param("from")) if "from" in query else None,
+        "to_date": date_validator(param("to")) if "to" in query else None,
+    }
+
+
+def _post_json(post):
+    return {
+        "id": post.id,
+        "url": post.url,
+        "date": post.date.isoformat(),
+        "likes": post.likes,
+        "reposts": post.reposts,
+        "comments": post.comments,
+        "views": post.views,
+    }
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(pages, host=constants.SERVE_HOST, port=constants.SERVE_PORT):
+    """ Returns HTTP server answering queries from PageCache 'pages' """
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            logger.debug(fmt % args)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/top":
+                return self._reply(404, {"error": "not found"})
+
+            try:
+                query = parse_query(parse_qs(url.query))
+            except (ArgumentTypeError, ValueError) as error:
+                return self._reply(400, {"error": str(error)})
+
+            try:
+                page_id = pages.resolve(query.pop("url"))
+            except (VKApiError, requests.exceptions.RequestException) as error:
+                return self._reply(502, {"error": str(error)})
+            except RuntimeError as error:
+                return self._reply(404, {"error": str(error)})
+
+            snapshot = pages.snapshot(page_id)
+            if snapshot is None:
+                return self._reply(503, {"error": "page is not downloaded yet"})
+
+            posts = snapshot.top(**query)
+            self._reply(
+                200,
+                {
+                    "page": page_id,
+                    "updated": int(snapshot.updated),
+                    "posts": [_post_json(post) for post in posts],
+                },
+            )
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(args):
+    """ Runs 'vktop serve' with arguments given by argparser.parse_serve_args """
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    try:
+        tokens = load_tokens(args.tokens)
+    except (IOError, ValueError) as error:
+        logger.error(error)
+        return 1
+
+    api_options = {"timeout": args.timeout}
+    set_token_pool(TokenPool(tokens, max_rate=args.rate, strategy=args.token_strategy))
+
+    try:
+        names_cache = None if args.no_cache else ScreenNameCache()
+    except (OSError, sqlite3.Error) as error:
+        logger.warning("Screen names cache is unavailable: {}".format(error))
+        names_cache = None
+
+    pages = PageCache(
+        args.interval,
+        args.refreshes,
+        args.days,
+        {
+            "batch_size": args.batch,
+            "api_options": api_options,
+            "keep_text": False,
+            "lean": args.lean,
+        },
+        names_cache,
+    )
+
+    urls = list(args.urls)
+    try:
+        if args.input:
+            urls.extend(url for _, url in read_urls(args.input))
+    except IOError as error:
+        logger.error(error)
+        return 1
+
+    for url in urls:
+        try:
+            pages.track(pages.resolve(url))
+        except (RuntimeError, requests.exceptions.RequestException) as error:
+            logger.error(error)
+
+    server = make_server(pages, args.host, args.port)
+    logger.info("Serving on http://{}:{}/top".format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if names_cache is not None:
+            names_cache.close()
+    return 0
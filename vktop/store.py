@@ -0,0 +1,501 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import time
+import sqlite3
+import datetime
+import logging
+
+from .constants import TRENDING_GRAVITY
+from .post import Post
+from .ranking import rank
+from .search import tokenize, prefix_range
+
+logger = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    page_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    date INTEGER NOT NULL,
+    likes INTEGER NOT NULL,
+    reposts INTEGER NOT NULL,
+    is_pinned INTEGER NOT NULL,
+    text TEXT,
+    comments INTEGER NOT NULL DEFAULT 0,
+    views INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (page_id, id)
+);
+CREATE INDEX IF NOT EXISTS posts_date ON posts (page_id, date);
+CREATE TABLE IF NOT EXISTS pages (
+    page_id INTEGER PRIMARY KEY,
+    synced_from INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    page_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    likes INTEGER NOT NULL,
+    reposts INTEGER NOT NULL,
+    PRIMARY KEY (page_id, id, time)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS syncs (
+    page_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    PRIMARY KEY (page_id, time)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term_id INTEGER NOT NULL,
+    page_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (term_id, page_id, id)
+) WITHOUT ROWID;
+"""
+
+# Columns added after the first release, created in older stores on open
+MIGRATIONS = (
+    ("comments", "ALTER TABLE posts ADD COLUMN comments INTEGER NOT NULL DEFAULT 0"),
+    ("views", "ALTER TABLE posts ADD COLUMN views INTEGER NOT NULL DEFAULT 0"),
+)
+
+# Terms looked up per statement, SQLite allows 999 variables by default
+TERMS_PER_QUERY = 500
+
+# Rankings computed by SQLite, the rest are computed by ranking module
+ORDER_BY = {
+    "likes": "likes DESC, reposts DESC",
+    "reposts": "reposts DESC, likes DESC",
+}
+
+
+class PostStore:
+    """
+    SQLite storage of downloaded posts.
+    For every page it remembers the earliest date since which all posts
+    are stored, so subsequent runs download only new posts and refresh
+    counters of recent ones.
+    Likes and reposts of every run are appended to snapshots table, but
+    only for posts whose counters have changed since the previous run,
+    so counters of a post at any moment are ones of its latest snapshot.
+    Times of runs are kept in syncs table.
+    Texts of posts are indexed: postings table lists posts of every term,
+    see search.tokenize.
+    Dates are stored as ordinals of datetime.date, times as Unix time.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        indexed = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'postings'"
+        ).fetchone()
+        self.connection.executescript(SCHEMA)
+        self._migrate()
+        # Posts stored before texts were indexed
+        if indexed is None:
+            self._reindex()
+
+    def _migrate(self):
+        columns = set(
+            row[1] for row in self.connection.execute("PRAGMA table_info(posts)")
+        )
+        with self.connection:
+            for column, statement in MIGRATIONS:
+                if column not in columns:
+                    self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def sync_from(self, page_id, from_date=None, refresh_days=7):
+        """
+        Returns date since which posts of the page should be downloaded
+        to have all posts published after 'from_date' in the store.
+        """
+        from_date = from_date or datetime.date.min
+
+        synced_from = self.connection.execute(
+            "SELECT synced_from FROM pages WHERE page_id = ?", (page_id,)
+        ).fetchone()
+        if synced_from is None or from_date.toordinal() < synced_from[0]:
+            return from_date
+
+        # Counters of posts older than refresh window barely change
+        refresh_from = datetime.date.today() - datetime.timedelta(days=refresh_days)
+        newest = self._newest_date(page_id)
+        if newest is not None:
+            refresh_from = min(refresh_from, newest)
+        return max(from_date, refresh_from)
+
+    def _newest_date(self, page_id):
+        newest = self.connection.execute(
+            "SELECT MAX(date) FROM posts WHERE page_id = ? AND is_pinned = 0",
+            (page_id,),
+        ).fetchone()[0]
+        return datetime.date.fromordinal(newest) if newest is not None else None
+
+    def save(self, page_id, posts, fetched_from, now=None):
+        """
+        Stores posts downloaded since 'fetched_from' date, overwriting
+        counters of already stored posts, and snapshots of changed counters
+        taken at 'now' (current time by default).
+        """
+        newest = self._newest_date(page_id)
+        now = int(time.time() if now is None else now)
+
+        with self.connection:
+            self._remove_deleted(page_id, posts, fetched_from)
+            self._record(page_id, posts, now)
+            self._index(page_id, posts)
+            # Posts downloaded in lean mode have no texts, stored ones are kept
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO posts "
+                "(page_id, id, date, likes, reposts, is_pinned, text, comments, views) "
+                "VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, (SELECT text FROM posts "
+                "WHERE page_id = ? AND id = ?)), ?, ?)",
+                (
+                    (
+                        page_id,
+                        post.id,
+                        post.date.toordinal(),
+                        post.likes,
+                        post.reposts,
+                        post.is_pinned,
+                        post.text,
+                        page_id,
+                        post.id,
+                        post.comments,
+                        post.views,
+                    )
+                    for post in posts
+                ),
+            )
+
+            # Downloaded posts adjoin stored ones, coverage grows
+            if newest is not None and fetched_from <= newest:
+                self.connection.execute(
+                    "UPDATE pages SET synced_from = MIN(synced_from, ?) "
+                    "WHERE page_id = ?",
+                    (fetched_from.toordinal(), page_id),
+                )
+            else:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO pages VALUES (?, ?)",
+                    (page_id, fetched_from.toordinal()),
+                )
+        logger.debug("Stored {} posts of page {}".format(len(posts), page_id))
+
+    def _remove_deleted(self, page_id, posts, fetched_from):
+        """
+        Removes stored posts published since 'fetched_from' which are
+        missing from downloaded 'posts', so they were deleted from the wall.
+        Pinned post may be older, it is kept.
+        """
+        downloaded = set(post.id for post in posts)
+        deleted = [
+            (id, text)
+            for id, text in self.connection.execute(
+                "SELECT id, text FROM posts "
+                "WHERE page_id = ? AND date >= ? AND is_pinned = 0",
+                (page_id, fetched_from.toordinal()),
+            )
+            if id not in downloaded
+        ]
+        if not deleted:
+            return
+        self._update_postings(
+            (),
+            (
+                (term, page_id, id)
+                for id, text in deleted
+                for term in set(tokenize(text))
+            ),
+        )
+        for table in ("posts", "snapshots"):
+            self.connection.executemany(
+                "DELETE FROM {} WHERE page_id = ? AND id = ?".format(table),
+                ((page_id, id) for id, _ in deleted),
+            )
+        logger.debug(
+            "Removed {} deleted posts of page {}".format(len(deleted), page_id)
+        )
+
+    def _record(self, page_id, posts, now):
+        """ Appends snapshots of posts whose counters have changed """
+        if not len(posts):
+            return
+        # Posts stored before snapshots were introduced have none yet
+        first_sync = (
+            self.connection.execute(
+                "SELECT 1 FROM syncs WHERE page_id = ? LIMIT 1", (page_id,)
+            ).fetchone()
+            is None
+        )
+        stored = dict(
+            (id, (likes, reposts))
+            for id, likes, reposts in self.connection.execute(
+                "SELECT id, likes, reposts FROM posts WHERE page_id = ? AND date >= ?",
+                (page_id, min(post.date for post in posts).toordinal()),
+            )
+        )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)",
+            (
+                (page_id, post.id, now, post.likes, post.reposts)
+                for post in posts
+                if first_sync or stored.get(post.id) != (post.likes, post.reposts)
+            ),
+        )
+        self.connection.execute(
+            "INSERT OR REPLACE INTO syncs VALUES (?, ?)", (page_id, now)
+        )
+
+    def top(
+        self, page_id, limit, sort_by="likes", from_date=None, to_date=None, match=None
+    ):
+        """
+        Returns 'limit' most popular posts published within date range.
+        'sort_by' is a name of ranking.RANKINGS or a score expression.
+        If search.Query 'match' is given, only posts matching it are ranked.
+        """
+        query = (
+            "SELECT id, likes, reposts, date, text, is_pinned, comments, views "
+            "FROM posts WHERE page_id = ? AND date BETWEEN ? AND ?"
+        )
+        params = (
+            page_id,
+            (from_date or datetime.date.min).toordinal(),
+            (to_date or datetime.date.max).toordinal(),
+        )
+        if match is not None:
+            clause, match_params = self._match_clause(page_id, match)
+            query += " AND " + clause
+            params += match_params
+        if sort_by in ORDER_BY:
+            query += " ORDER BY {} LIMIT ?".format(ORDER_BY[sort_by])
+            params += (limit,)
+        else:
+            # Posts are read in wall order, same as they are downloaded
+            query += " ORDER BY is_pinned DESC, date DESC, id DESC"
+
+        posts = [
+            Post(
+                id=id,
+                likes=likes,
+                reposts=reposts,
+                date=datetime.date.fromordinal(date),
+                text=text,
+                is_pinned=is_pinned,
+                page_id=page_id,
+                comments=comments,
+                views=views,
+            )
+            for id, likes, reposts, date, text, is_pinned, comments, views in (
+                self.connection.execute(query, params)
+            )
+        ]
+        if sort_by in ORDER_BY:
+            return posts
+        return rank(posts, sort_by, limit)
+
+    def _term_ids(self, terms):
+        """ Returns term -> id of terms, adding new ones to terms table """
+        terms = list(terms)
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO terms (term) VALUES (?)", ((term,) for term in terms)
+        )
+        ids = {}
+        for i in range(0, len(terms), TERMS_PER_QUERY):
+            chunk = terms[i : i + TERMS_PER_QUERY]
+            ids.update(
+                self.connection.execute(
+                    "SELECT term, id FROM terms WHERE term IN ({})".format(
+                        ", ".join("?" * len(chunk))
+                    ),
+                    chunk,
+                )
+            )
+        return ids
+
+    def _update_postings(self, added, removed=()):
+        """ Adds and removes (term, page_id, id) postings """
+        added, removed = list(added), list(removed)
+        ids = self._term_ids(set(term for term, _, _ in added + removed))
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO postings VALUES (?, ?, ?)",
+            ((ids[term], page_id, id) for term, page_id, id in added),
+        )
+        self.connection.executemany(
+            "DELETE FROM postings WHERE term_id = ? AND page_id = ? AND id = ?",
+            ((ids[term], page_id, id) for term, page_id, id in removed),
+        )
+
+    def _index(self, page_id, posts):
+        """ Indexes texts of posts which are new or have been edited """
+        posts = [post for post in posts if post.text is not None]
+        if not posts:
+            return
+        stored = dict(
+            self.connection.execute(
+                "SELECT id, text FROM posts WHERE page_id = ? AND date >= ?",
+                (page_id, min(post.date for post in posts).toordinal()),
+            )
+        )
+        added, removed = [], []
+        for post in posts:
+            if post.id in stored and stored[post.id] == post.text:
+                continue
+            old, new = set(tokenize(stored.get(post.id))), set(tokenize(post.text))
+            added.extend((term, page_id, post.id) for term in new - old)
+            removed.extend((term, page_id, post.id) for term in old - new)
+        self._update_postings(added, removed)
+
+    def _reindex(self):
+        """ Indexes texts of all stored posts """
+        with self.connection:
+            self._update_postings(
+                (term, page_id, id)
+                for page_id, id, text in self.connection.execute(
+                    "SELECT page_id, id, text FROM posts WHERE text IS NOT NULL"
+                ).fetchall()
+                for term in set(tokenize(text))
+            )
+
+    def _match_clause(self, page_id, match, column="id"):
+        """
+        Returns SQL condition on 'column' of post ids and its parameters
+        selecting posts which match search.Query.
+        """
+        subquery = (
+            "{} IN (SELECT postings.id FROM terms JOIN postings "
+            "ON postings.term_id = terms.id WHERE {} AND postings.page_id = ?)"
+        )
+        clauses, params = [], []
+        for term in match.terms:
+            clauses.append(subquery.format(column, "terms.term = ?"))
+            params.extend((term, page_id))
+        for prefix in match.prefixes:
+            clauses.append(
+                subquery.format(column, "terms.term >= ? AND terms.term < ?")
+            )
+            params.extend(prefix_range(prefix) + (page_id,))
+        return " AND ".join(clauses), tuple(params)
+
+    def _last_sync(self, page_id, before):
+        return self.connection.execute(
+            "SELECT MAX(time) FROM syncs WHERE page_id = ? AND time <= ?",
+            (page_id, before),
+        ).fetchone()[0]
+
+    def trending(
+        self,
+        page_id,
+        limit,
+        hours,
+        counter="likes",
+        from_date=None,
+        to_date=None,
+        now=None,
+        match=None,
+    ):
+        """
+        Returns 'limit' posts published within date range whose 'counter'
+        (likes or reposts) grew the fastest within the last 'hours'.
+        If search.Query 'match' is given, only posts matching it are ranked.
+        Growth per hour is divided by (age in hours + 2) ** TRENDING_GRAVITY,
+        so younger posts need less growth to trend.
+        """
+        now = time.time() if now is None else now
+        start = now - hours * 3600
+        # Counters of stored posts are ones of the latest run, growth is
+        # measured since the last run before the window
+        synced = self._last_sync(page_id, now)
+        if synced is None:
+            return []
+        since = self._last_sync(page_id, start)
+        born = datetime.date.fromtimestamp(start if since is None else since)
+
+        column = {"likes": "likes", "reposts": "reposts"}[counter]
+        query = (
+            "SELECT p.id, p.likes, p.reposts, p.date, p.text, p.is_pinned, "
+            "p.comments, p.views, b.{0}, f.time, f.{0} FROM posts p "
+            "LEFT JOIN snapshots b ON b.page_id = p.page_id AND b.id = p.id "
+            "AND b.time = (SELECT MAX(time) FROM snapshots "
+            "WHERE page_id = p.page_id AND id = p.id AND time <= ?) "
+            "LEFT JOIN snapshots f ON f.page_id = p.page_id AND f.id = p.id "
+            "AND f.time = (SELECT MIN(time) FROM snapshots "
+            "WHERE page_id = p.page_id AND id = p.id) "
+            "WHERE p.page_id = ? AND p.date BETWEEN ? AND ?".format(column)
+        )
+        params = (
+            -1 if since is None else since,
+            page_id,
+            (from_date or datetime.date.min).toordinal(),
+            (to_date or datetime.date.max).toordinal(),
+        )
+        if match is not None:
+            clause, match_params = self._match_clause(page_id, match, "p.id")
+            query += " AND " + clause
+            params += match_params
+
+        rows = self.connection.execute(query, params)
+
+        scored = []
+        for row in rows:
+            post = Post(
+                id=row[0],
+                likes=row[1],
+                reposts=row[2],
+                date=datetime.date.fromordinal(row[3]),
+                text=row[4],
+                is_pinned=row[5],
+                page_id=page_id,
+                comments=row[6],
+                views=row[7],
+            )
+            value = getattr(post, counter)
+            before, first_time, first_value = row[8:]
+            # Dates of posts are known up to a day
+            published = time.mktime(post.date.timetuple())
+            if first_time is None:
+                # Post stored before snapshots were introduced
+                base_time, base_value = synced, value
+            elif before is not None:
+                base_time, base_value = since, before
+            elif post.date >= born:
+                # Post published after the last run before the window
+                # grows from zero
+                base_time, base_value = published, 0
+            else:
+                # Post first downloaded within the window
+                base_time, base_value = first_time, first_value
+
+            growth = (value - base_value) / max((synced - base_time) / 3600.0, 1.0)
+            age = max((synced - published) / 3600.0, 0.0)
+            scored.append((growth / (age + 2) ** TRENDING_GRAVITY, value, post))
+
+        scored.sort(key=lambda item: (-item[0], -item[1]))
+        return [post for _, _, post in scored[:limit]]
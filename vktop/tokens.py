@@ -0,0 +1,178 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Yutkin Dmitry
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Pool of VK API access tokens requests are spread across.
+Every token has its own rate limiter, so throughput grows with number
+of tokens. Tokens failing on their own (throttled, exhausted or revoked)
+are taken out of rotation for a while.
+"""
+
+import io
+import os
+import re
+import time
+
+from . import constants
+from .ratelimit import RateLimiter
+
+ROUND_ROBIN = "round-robin"
+LEAST_LOADED = "least-loaded"
+STRATEGIES = (ROUND_ROBIN, LEAST_LOADED)
+
+
+def default_tokens_path():
+    """ Returns path of tokens file in user's config directory """
+    config_dir = os.environ.get("XDG_CONFIG_HOME") or os.path.join(
+        os.path.expanduser("~"), ".config"
+    )
+    return os.path.join(config_dir, "vktop", "tokens")
+
+
+def read_tokens(path):
+    """ Reads tokens from file, one per line, lines starting with # are skipped """
+    with io.open(path, encoding="utf-8") as tokens_file:
+        lines = (line.strip() for line in tokens_file)
+        return [line for line in lines if line and not line.startswith("#")]
+
+
+def load_tokens(path=None):
+    """
+    Returns access tokens from file 'path' if given, otherwise from
+    VKTOP_TOKENS environment variable (separated by commas or spaces) or
+    default tokens file. Falls back to the application's own key.
+    """
+    if path:
+        tokens = read_tokens(path)
+    elif os.environ.get("VKTOP_TOKENS"):
+        tokens = re.split(r"[\s,]+", os.environ["VKTOP_TOKENS"].strip())
+    elif os.path.isfile(default_tokens_path()):
+        tokens = read_tokens(default_tokens_path())
+    else:
+        tokens = [constants.APP_ACCESS_KEY]
+    # Order is kept, duplicates would share the same API quota anyway
+    unique = []
+    for token in tokens:
+        if token and token not in unique:
+            unique.append(token)
+    if not unique:
+        raise ValueError("No access tokens in {}".format(path or "VKTOP_TOKENS"))
+    return unique
+
+
+class TokenPool:
+    """
+    Access tokens with their rate limiters.
+    State lives in shared memory, so a single pool can be handed to
+    worker processes and all of them pick tokens together.
+
+    'round-robin' strategy takes tokens in turn, 'least-loaded' one takes
+    the token with the fewest requests in flight (including requests
+    waiting for its rate limiter).
+    """
+
+    def __init__(
+        self,
+        tokens,
+        max_rate=constants.API_MAX_RPS,
+        min_rate=constants.API_MIN_RPS,
+        strategy=ROUND_ROBIN,
+    ):
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown token strategy {}".format(strategy))
+        self.tokens = list(tokens)
+        self.strategy = strategy
+        self.limiters = [RateLimiter(max_rate, min_rate) for _ in self.tokens]
+        import multiprocessing
+
+        # Times tokens are suspended till, requests in flight of every token
+        # and index of the next token in turn
+        self._state = multiprocessing.Array("d", 2 * len(self.tokens) + 1)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, index):
+        return self.tokens[index]
+
+    def acquire(self):
+        """
+        Picks token for the next request and counts the request as in flight.
+        Returns index of the token, request must wait for its limiter and
+        then be released.
+        Suspended tokens are skipped, when all of them are suspended the one
+        to come back first is used.
+        """
+        n = len(self.tokens)
+        with self._state.get_lock():
+            state = self._state
+            now = time.time()
+            turn = int(state[2 * n])
+            # Tokens in order of their turns
+            order = [(turn + i) % n for i in range(n)]
+            ready = [i for i in order if state[i] <= now]
+            if not ready:
+                index = min(order, key=lambda i: state[i])
+            elif self.strategy == LEAST_LOADED:
+                index = min(ready, key=lambda i: state[n + i])
+            else:
+                index = ready[0]
+            state[2 * n] = (index + 1) % n
+            state[n + index] += 1
+        return index
+
+    def release(self, index):
+        """ Marks request made with token 'index' as finished """
+        n = len(self.tokens)
+        with self._state.get_lock():
+            self._state[n + index] = max(self._state[n + index] - 1, 0)
+
+    def suspend(self, index, seconds):
+        """ Takes token out of rotation for 'seconds' """
+        with self._state.get_lock():
+            self._state[index] = max(self._state[index], time.time() + seconds)
+
+    def available(self):
+        """ Returns whether some token is not suspended """
+        now = time.time()
+        with self._state.get_lock():
+            return any(self._state[i] <= now for i in range(len(self.tokens)))
+
+
+_pool = None
+
+
+def get_token_pool():
+    """ Returns token pool shared by all API clients of the process """
+    global _pool
+    if _pool is None:
+        _pool = TokenPool([constants.APP_ACCESS_KEY])
+    return _pool
+
+
+def set_token_pool(pool):
+    """
+    Replaces shared token pool.
+    Used as initializer of worker processes to pass parent's pool.
+    """
+    global _pool
+    _pool = pool
@@ -20,59 +20,120 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import requests
+from __future__ import print_function
+
+import io
+import sys
 import logging
 
-from . import constants
+# VKApiError is re-exported, it used to live here
+from .api import VKApiError, get_client  # noqa: F401
+from .constants import EXECUTE_MAX_CALLS
 
 logger = logging.getLogger()
 
 
-class VKApiError(RuntimeError):
-    """"""
+def _page_id(resolved):
+    """ Returns page's numeric ID given response of utils.resolveScreenName """
+    if resolved["type"] == "user":
+        return resolved["object_id"]
+    else:
+        return -resolved["object_id"]
 
 
-def get_page_id(url):
-    """ Returns page's numeric ID """
-    params = {
-        "screen_name": url["id"],
-        "v": constants.VKAPI_VERSION,
-        "access_token": constants.APP_ACCESS_KEY,
-    }
-    if url["type"] == "domain":
-        request = requests.get(
-            constants.VKAPI_URL + "utils.resolveScreenName", params=params
+def get_page_ids(urls, api=None, cache=None):
+    """
+    Returns numeric IDs of pages, None for unresolved screen names.
+    Screen names are looked up in 'cache' (resolver.ScreenNameCache) first,
+    the rest are resolved in bulk, many names per request.
+    """
+    names = set(url["id"] for url in urls if url["type"] == "domain")
+
+    resolved = {}
+    if cache is not None:
+        for name in names:
+            page_id = cache.get(name)
+            if page_id is not None:
+                resolved[name] = page_id
+
+    missed = sorted(names - set(resolved))
+    if missed:
+        logger.debug("Resolving {} screen names".format(len(missed)))
+        api = api or get_client()
+
+    fresh = {}
+    for i in range(0, len(missed), EXECUTE_MAX_CALLS):
+        chunk = missed[i : i + EXECUTE_MAX_CALLS]
+        if len(chunk) == 1:
+            results = [api.call("utils.resolveScreenName", screen_name=chunk[0])]
+        else:
+            results = api.execute(
+                "utils.resolveScreenName", [{"screen_name": name} for name in chunk]
+            )
+        # Unknown screen name is resolved to empty result
+        fresh.update(
+            (name, _page_id(result)) for name, result in zip(chunk, results) if result
         )
-        response = request.json()
-
-        if response.get("response"):
-            response = response["response"]
-            if response["type"] == "user":
-                return response["object_id"]
-            else:
-                return -response["object_id"]
+
+    if fresh and cache is not None:
+        cache.put_many(fresh)
+    resolved.update(fresh)
+
+    page_ids = []
+    for url in urls:
+        if url["type"] == "domain":
+            if url["id"] not in resolved:
+                logger.error("Troubles with resolving {} id".format(url["id"]))
+            page_ids.append(resolved.get(url["id"]))
         else:
-            logger.error(response)
-            raise RuntimeError("Troubles with resolving {} id".format(url["id"]))
+            id = int(url["id"])
+            page_ids.append(id if url["type"] == "id" else -id)
+    return page_ids
 
-    id = int(url["id"])
-    return id if url["type"] == "id" else -id
 
+def get_page_id(url, api=None, cache=None):
+    """ Returns page's numeric ID """
+    page_id = get_page_ids([url], api, cache)[0]
+    if page_id is None:
+        raise RuntimeError("Troubles with resolving {} id".format(url["id"]))
+    return page_id
 
-def pretty_print(posts, col_indent_len=6):
-    """ Prints results as a pretty table """
 
-    if not posts:
-        logger.warning("There are no any posts for showing.")
-        return
+def read_urls(path):
+    """
+    Reads page urls from file, one per line, '-' means stdin.
+    Returns pairs of url text and parsed url, invalid urls are skipped.
+    """
+    from .argparser import url_validator
+    from argparse import ArgumentTypeError
+
+    lines = sys.stdin if path == "-" else io.open(path, encoding="utf-8")
+    urls = []
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                urls.append((line, url_validator(line)))
+            except ArgumentTypeError as error:
+                logger.warning(error)
+    finally:
+        # stdin is not ours to close
+        if lines is not sys.stdin:
+            lines.close()
+    return urls
+
 
+def format_table(posts, col_indent_len=6):
+    """ Returns posts formatted as a pretty table """
     longest_url_len = max([len(post.url) for post in posts])
     longest_likes_len = max([len(str(post.likes)) for post in posts])
     longest_reposts_len = max([len(str(post.reposts)) for post in posts])
 
     # This header print was hardcoded and cannot be properly explained. :(
     # But it adjusts to col_indent_len parameter.
-    print(
+    lines = [
         "\n{0:^{4}} {1:^{5}} {2:^{6}} {3:^{7}}".format(
             "URL",
             "Date",
@@ -83,7 +144,7 @@ def pretty_print(posts, col_indent_len=6):
             longest_likes_len,
             2 * col_indent_len + longest_reposts_len - 1,
         )
-    )
+    ]
     for i, post in enumerate(posts):
         data = {
             "ind": str(i + 1) + ".",
@@ -96,7 +157,18 @@ def pretty_print(posts, col_indent_len=6):
             "date": post.date,
             "date_len": col_indent_len + 10,
         }
-        print(
+        lines.append(
             "{ind:<3} {url:<{url_len}} {date!s:<{date_len}} {likes:<{likes_len}}"
             "{reposts:<{reposts_len}}".format(**data)
         )
+    return "\n".join(lines)
+
+
+def pretty_print(posts, col_indent_len=6):
+    """ Prints results as a pretty table """
+
+    if not posts:
+        logger.warning("There are no any posts for showing.")
+        return
+
+    print(format_table(posts, col_indent_len))